@@ -0,0 +1,335 @@
+#%%
+# Benchmarks for the functions in Functions.py, run with "python Benchmarks.py" from the notebooks directory
+import logging as lgr
+import os
+import json
+import socket
+import glob
+import tempfile
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+import numpy as np
+import pandas as pd
+import xarray as xr
+from scipy.optimize import linear_sum_assignment
+try : import wasserstein
+except: pass
+from Functions import emd_grid, emd_distance_function, RuntimeConfig, default_num_threads, open_and_preprocess, emd_means, euclidean_kmeans, coreset_clustering, euclidean_assignment, quantize_histograms, precomputed_clusters, cloud_regime_statistics, draw_cluster_centers, render_figures, peak_rss_mb, current_rss_mb, open_and_process, create_land_mask
+#%%
+
+# Create n random histograms on an (n1, n2) tau/height grid, shaped like the (n_histograms, n_tau_bins * n_pc_bins) matrix returned by open_and_process
+def synthetic_histograms(n, n1=6, n2=7, seed=0):
+    rng = np.random.default_rng(seed)
+    # Sparse, mostly single peaked histograms with a random total cloud fraction, like ISCCP and MODIS histograms
+    mat = rng.dirichlet(np.full(n1 * n2, 0.3), size=n)
+    mat *= rng.random((n, 1))
+    return mat
+
+# Create n random histograms drawn around k random prototype histograms, with the prototype each was drawn from, for checks that need clusters to exist in the data
+def clustered_histograms(n, k, n1=6, n2=7, concentration=200, seed=0):
+    rng = np.random.default_rng(seed)
+    prototypes = rng.dirichlet(np.full(n1 * n2, 0.3), size=k)
+    labels = rng.integers(k, size=n)
+    mat = np.array([rng.dirichlet(concentration * prototypes[label] + 0.01) for label in labels])
+    mat *= rng.uniform(0.2, 1, (n, 1))
+    return mat, labels
+
+# Run func(*args) and return how long it took and the memory it used. With mat_path, the histogram matrix saved there is loaded first and passed as the first argument
+def _measure(func, args, mat_path=None):
+    if mat_path is not None: args = (np.load(mat_path),) + args
+    baseline = current_rss_mb()
+    s = perf_counter()
+    func(*args)
+    return {'seconds': perf_counter() - s, 'baseline_rss_mb': baseline, 'peak_rss_mb': peak_rss_mb()}
+
+# Run func(*args) in a fresh process, so the peak memory of one benchmark does not hide the peak memory of the next
+def run_in_subprocess(func, *args, mat_path=None):
+    with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as executor:
+        return executor.submit(_measure, func, args, mat_path).result()
+
+# The events format documented by the wasserstein package: a list with a (n_bins, 3) array of weights and bin positions for every histogram
+def stacked_events(position_matrix, mat):
+    events = []
+    for histogram in mat:
+        x = np.empty((len(histogram), 3))
+        x[:,0] = histogram
+        x[:,1] = position_matrix[0]
+        x[:,2] = position_matrix[1]
+        events.append(x)
+    return events
+
+# EMDs between synthetic histograms and centroids, passing the histograms to wasserstein.PairwiseEMD as a list of (n_bins, 3) arrays
+def stacked_events_emds(n, k, n1, n2):
+    mat = synthetic_histograms(n, n1, n2)
+    position_matrix, R = emd_grid(n1, n2)
+    emds = wasserstein.PairwiseEMD(R = R, norm=True, dtype=np.float32, verbose=0)
+    emds(stacked_events(position_matrix, mat), stacked_events(position_matrix, mat[:k]))
+    return emds.emds()
+
+# EMDs between synthetic histograms and centroids, using emd_distance_function which shares one array of bin positions between all histograms
+def shared_events_emds(n, k, n1, n2):
+    mat = synthetic_histograms(n, n1, n2)
+    return emd_distance_function(n1, n2)(mat, mat[:k])
+
+# Compare the time and peak memory of computing EMDs with a list of (n_bins, 3) arrays per histogram, and with shared bin positions
+def benchmark_event_memory(n=10**6, k=8, n1=6, n2=7):
+    results = {}
+    for name, func in [('stacked events', stacked_events_emds), ('shared events', shared_events_emds)]:
+        results[name] = run_in_subprocess(func, n, k, n1, n2)
+        print(f"{name:>16}: {results[name]['seconds']:7.1f} seconds, peak RSS {results[name]['peak_rss_mb']:8.0f} MB for {n} histograms of {n1 * n2} bins")
+    return results
+
+# Time EMDs between n synthetic histograms and k centroids with a range of thread counts, to show where throughput stops increasing
+def benchmark_thread_scaling(n=10**5, k=8, n1=6, n2=7, thread_counts=None, emd_backend="wasserstein"):
+    if thread_counts is None:
+        thread_counts = [2**i for i in range(int(np.log2(default_num_threads())) + 1)]
+        if thread_counts[-1] != default_num_threads(): thread_counts.append(default_num_threads())
+    mat = synthetic_histograms(n, n1, n2)
+    centroids = mat[:k]
+
+    results = {}
+    for num_threads in thread_counts:
+        emd = emd_distance_function(n1, n2, emd_backend, config=RuntimeConfig(num_threads=num_threads))
+        s = perf_counter()
+        emd(mat, centroids)
+        results[num_threads] = n * k / (perf_counter() - s)
+        print(f"{num_threads:>4} threads: {results[num_threads]:12.0f} EMDs per second ({results[num_threads] / results[thread_counts[0]]:.2f}x)")
+    return results
+
+# Tau and pressure bin centers of synthetic histograms with n_tau valid tau bins and n_pc pressure bins, plus a -1 tau bin for failed retrievals
+# that open_and_preprocess drops. The default 6 x 7 grid uses the ISCCP bins, which MODIS histograms share the shape of
+def synthetic_bins(n_tau=6, n_pc=7):
+    if (n_tau, n_pc) == (6, 7): return np.array([-1, 0.15, 0.8, 2.45, 6.5, 16.2, 41.5]), np.array([90., 245., 375., 500., 620., 740., 900.])
+    return np.concatenate([[-1], np.geomspace(0.15, 41.5, n_tau)]), np.linspace(90, 900, n_pc)
+
+# Write n_files NetCDF files of n_time days each of synthetic ISCCP-like histograms on a (n_lat, n_lon) grid to directory, with an extra variable that should be dropped on opening
+def write_synthetic_files(directory, n_files=100, n_time=1, n_lat=45, n_lon=72, seed=0, n_tau=6, n_pc=7):
+    rng = np.random.default_rng(seed)
+    levtau, levpc = synthetic_bins(n_tau, n_pc)
+    lat = np.linspace(-90, 90, n_lat)
+    lon = np.arange(n_lon) * 360 / n_lon
+    os.makedirs(directory, exist_ok=True)
+    for i, day in enumerate(pd.date_range('2000-01-01', periods=n_files * n_time, freq='D')[::n_time]):
+        time = pd.date_range(day, periods=n_time, freq='D')
+        histograms = synthetic_histograms(n_time * n_lat * n_lon, len(levtau), len(levpc), seed=rng.integers(2**31)) * 100
+        histograms = histograms.reshape(n_time, n_lat, n_lon, len(levtau), len(levpc)).transpose(0, 4, 3, 1, 2)
+        xr.Dataset({'n_pctaudist':(('time', 'levpc', 'levtau', 'lat', 'lon'), histograms.astype(np.float32)),
+                    'other':(('time', 'lat', 'lon'), rng.random((n_time, n_lat, n_lon)))},
+                   coords={'time':time, 'levpc':levpc, 'levtau':levtau, 'lat':lat, 'lon':lon}).to_netcdf(os.path.join(directory, f'synthetic_{i:05d}.nc'))
+    return os.path.join(directory, 'synthetic_*.nc')
+
+# The way files were opened before the file index: open the first file to find the variables to drop, then open every file serially
+def serial_open(data_path, var_name):
+    files = glob.glob(data_path)
+    remove = list(xr.open_mfdataset(files[0]).keys())
+    remove.remove(var_name)
+    return xr.open_mfdataset(files, drop_variables = remove)[var_name]
+
+# Compare how long it takes to open n_files synthetic files serially, and with open_and_preprocess in parallel without and with a file index
+def benchmark_open(n_files=200, directory=None, time_range=None):
+    directory = directory or tempfile.mkdtemp()
+    data_path = write_synthetic_files(directory, n_files)
+    args = dict(var_name='n_pctaudist', tau_var_name='levtau', ht_var_name='levpc', lat_var_name='lat', lon_var_name='lon', height_or_pressure='p', time_range=time_range)
+    index_path = os.path.join(directory, '.file_index.json')
+    if os.path.isfile(index_path): os.remove(index_path)
+
+    results = {}
+    for name, func in [('serial', lambda: serial_open(data_path, 'n_pctaudist')),
+                       ('parallel, no index', lambda: open_and_preprocess(data_path, **args, index_path=index_path)),
+                       ('parallel, index', lambda: open_and_preprocess(data_path, **args, index_path=index_path))]:
+        s = perf_counter()
+        func()
+        results[name] = perf_counter() - s
+        print(f"{name:>20}: {results[name]:7.2f} seconds to open {n_files} files")
+    return results
+
+# Area weighted inertia of clustering mat into cl, with squared EMDs or squared euclidean distances
+def weighted_inertia(mat, cl, weights, wasserstein_or_euclidean, n1, n2):
+    if wasserstein_or_euclidean == "wasserstein": distances = np.min(emd_distance_function(n1, n2)(mat, cl), axis=1)**2
+    else: distances = euclidean_assignment(mat, cl)[1]
+    return np.sum(weights * distances) / np.sum(weights)
+
+# Compare clustering n synthetic histograms directly with clustering a coreset of coreset_size of them followed by one assignment pass
+# Reports the speedup and how much higher the full data inertia of the coreset centroids is
+def benchmark_coreset(n=10**5, k=8, coreset_size=5000, wasserstein_or_euclidean="euclidean", n1=6, n2=7, n_init=3, max_iter=100, tol=1e-4):
+    mat = synthetic_histograms(n, n1, n2)
+    weights = np.cos(np.deg2rad(np.random.default_rng(1).uniform(-60, 60, n)))
+    ds = xr.Dataset(coords={'levtau':np.arange(n1), 'levpc':np.arange(n2)})
+
+    s = perf_counter()
+    if wasserstein_or_euclidean == "wasserstein":
+        cl_full, _, _, _ = emd_means(mat, k, tol, 'k-means++', n_init, ds, 'levtau', 'levpc', max_iter, weights=weights, config=RuntimeConfig(rng=np.random.default_rng(0)))
+    else:
+        cl_full, _ = euclidean_kmeans(k, 'k-means++', n_init, mat, max_iter, tol, config=RuntimeConfig(rng=np.random.default_rng(0)), weights=weights)
+    full_seconds = perf_counter() - s
+
+    s = perf_counter()
+    cl_coreset, _ = coreset_clustering(mat, k, coreset_size, wasserstein_or_euclidean, tol, 'k-means++', n_init, max_iter, weights, ds, 'levtau', 'levpc', config=RuntimeConfig(rng=np.random.default_rng(0)))
+    coreset_seconds = perf_counter() - s
+
+    full_inertia = weighted_inertia(mat, cl_full, weights, wasserstein_or_euclidean, n1, n2)
+    coreset_inertia = weighted_inertia(mat, cl_coreset, weights, wasserstein_or_euclidean, n1, n2)
+    results = {'full_seconds':full_seconds, 'coreset_seconds':coreset_seconds, 'speedup':full_seconds / coreset_seconds, 'inertia_gap':coreset_inertia / full_inertia - 1}
+    print(f"{wasserstein_or_euclidean:>12}: full data {full_seconds:7.1f} seconds, coreset of {coreset_size} {coreset_seconds:7.1f} seconds ({results['speedup']:.1f}x), "
+          f"inertia {100 * results['inertia_gap']:+.2f}% of full data fitting for {n} histograms")
+    return results
+
+# Fraction of histograms with the same label in labels and reference_labels, after matching up the k clusters of the two clusterings so they agree most
+def label_agreement(labels, reference_labels, k):
+    confusion = np.zeros((k, k))
+    np.add.at(confusion, (labels, reference_labels), 1)
+    rows, columns = linear_sum_assignment(-confusion)
+    return confusion[rows, columns].sum() / len(labels)
+
+# Cluster n synthetic histograms with emd_means (or euclidean_kmeans) with mat held as float64, float32, uint16 and uint8, and compare the memory used by mat,
+# the time taken and the labels against the float64 clustering, both from clustering again and from assigning histograms to the float64 centroids
+# Every clustering starts from the same k histograms, so the differences come from the precision of mat and not from k-means finding a different local minimum
+def benchmark_dtypes(n=2 * 10**4, k=6, n1=6, n2=7, wasserstein_or_euclidean="wasserstein", tol=1e-3, max_iter=45, dtypes=(np.float64, np.float32, np.uint16, np.uint8)):
+    mat64 = synthetic_histograms(n, n1, n2) * 100
+    weights = np.cos(np.deg2rad(np.random.default_rng(1).uniform(-60, 60, n)))
+    ds = xr.Dataset(coords={'levtau':np.arange(n1), 'levpc':np.arange(n2)})
+    init_rows = np.random.default_rng(2).choice(n, k, replace=False)
+
+    results = {}
+    for dtype in dtypes:
+        mat, scale_factor = quantize_histograms(mat64, dtype)
+        config = RuntimeConfig(rng=np.random.default_rng(0), dtype=np.float64 if dtype == np.float64 else np.float32)
+        s = perf_counter()
+        if wasserstein_or_euclidean == "wasserstein": cl, labels, _, _ = emd_means(mat, k, tol, mat[init_rows], 1, ds, 'levtau', 'levpc', max_iter, weights=weights, config=config)
+        else: cl, labels = euclidean_kmeans(k, mat[init_rows].astype(np.float32), 1, mat, max_iter, tol, config=config, weights=weights)
+        seconds = perf_counter() - s
+        if dtype == dtypes[0]: reference_cl, reference_labels = cl, labels
+        assigned = precomputed_clusters(mat, reference_cl / scale_factor, wasserstein_or_euclidean, ds, 'levtau', 'levpc', config=config)
+        results[np.dtype(dtype).name] = {'mat_mb':mat.nbytes / 1024**2, 'seconds':seconds, 'cluster_agreement':label_agreement(labels, reference_labels, k),
+                                         'assignment_agreement':np.mean(assigned == reference_labels)}
+        print(f"{np.dtype(dtype).name:>8}: mat {mat.nbytes / 1024**2:7.1f} MB, {seconds:6.1f} seconds to cluster, {100 * results[np.dtype(dtype).name]['cluster_agreement']:6.2f}% of labels "
+              f"agree after clustering, {100 * results[np.dtype(dtype).name]['assignment_agreement']:6.2f}% agree assigning to the {np.dtype(dtypes[0]).name} centroids")
+    return results
+
+# Statistics of k CRs with random labels on a (n_time, n_lat, n_lon) grid and random mean histograms, shaped like the output of cloud_regime_statistics
+def synthetic_statistics(k, n_time=20, n_lat=45, n_lon=72, n1=6, n2=7, seed=0):
+    rng = np.random.default_rng(seed)
+    labels = xr.DataArray(rng.integers(0, k, (n_time, n_lat, n_lon)).astype(np.float32), dims=('time', 'lat', 'lon'),
+                          coords={'lat':np.linspace(-88, 88, n_lat), 'lon':np.linspace(-177.5, 177.5, n_lon)})
+    stats = cloud_regime_statistics(labels, k)
+    stats['mean_histogram'] = xr.DataArray(rng.random((k, n1, n2)) * 10, dims=('cluster', 'levtau', 'levpc'), coords={'levtau':np.arange(n1), 'levpc':np.arange(n2)})
+    return stats
+
+# Compare saving n_figures cluster center figures with a new figure each time, with a reused figure template, and with render_figures across n_jobs processes
+def benchmark_rendering(n_figures=24, k=8, n_jobs=None, directory=None):
+    directory = directory or tempfile.mkdtemp()
+    stats = [synthetic_statistics(k, seed=i) for i in range(n_figures)]
+    tasks = [(draw_cluster_centers, dict(stats=stats[i], k=k, tau_var_name='levtau', ht_var_name='levpc', height_or_pressure='p', save_path=os.path.join(directory, f'{i}_')))
+             for i in range(n_figures)]
+
+    results = {}
+    for name, func in [('new figures', lambda: [function(**kwargs, show=False) for function, kwargs in tasks]),
+                       ('figure template', lambda: render_figures(tasks, n_jobs=1)),
+                       (f'render_figures', lambda: render_figures(tasks, n_jobs=n_jobs))]:
+        s = perf_counter()
+        func()
+        results[name] = perf_counter() - s
+        print(f"{name:>16}: {results[name]:6.2f} seconds to save {n_figures} figures ({results['new figures'] / results[name]:.1f}x)")
+    return results
+
+# Grids, resolutions and time lengths timed by benchmark_suite: ISCCP/MODIS shaped 6 x 7 histograms at 4 x 5 and 2 x 2.5 degrees over 30 days,
+# 4 x 5 degrees over 120 days, and a finer 6 x 15 tau/pressure grid
+suite_sizes = {'6x7 bins, 45x72 grid, 30 days':dict(n_tau=6, n_pc=7, n_lat=45, n_lon=72, n_files=30, n_time=1),
+               '6x7 bins, 90x144 grid, 30 days':dict(n_tau=6, n_pc=7, n_lat=90, n_lon=144, n_files=30, n_time=1),
+               '6x7 bins, 45x72 grid, 120 days':dict(n_tau=6, n_pc=7, n_lat=45, n_lon=72, n_files=30, n_time=4),
+               '6x15 bins, 45x72 grid, 30 days':dict(n_tau=6, n_pc=15, n_lat=45, n_lon=72, n_files=30, n_time=1)}
+
+# Open and preprocess synthetic files into a histogram matrix, as the notebooks do
+def suite_open_and_process(data_path, index_path):
+    return open_and_process(data_path, 1, 0, 1, 'k-means++', 1, 'n_pctaudist', 'levtau', 'levpc', 'lat', 'lon', 'p', cluster=False, index_path=index_path)[0]
+
+# A fixed number of emd_means iterations (tol = 0), so every run of a size does the same work
+def suite_emd_means(mat, k, n1, n2, max_iter, seed):
+    ds = xr.Dataset(coords={'levtau':np.arange(n1), 'levpc':np.arange(n2)})
+    emd_means(mat, k, 0, 'k-means++', 1, ds, 'levtau', 'levpc', hard_stop=max_iter, config=RuntimeConfig(rng=np.random.default_rng(seed)))
+
+def suite_euclidean_kmeans(mat, k, max_iter, seed):
+    euclidean_kmeans(k, 'k-means++', 1, mat, max_iter, 0, config=RuntimeConfig(rng=np.random.default_rng(seed)))
+
+# Wasserstein assignment of every histogram to k randomly chosen histograms
+def suite_precomputed_clusters(mat, k, n1, n2, seed):
+    ds = xr.Dataset(coords={'levtau':np.arange(n1), 'levpc':np.arange(n2)})
+    cl = mat[np.random.default_rng(seed).choice(len(mat), k, replace=False)]
+    precomputed_clusters(mat, cl, 'wasserstein', ds, 'levtau', 'levpc')
+
+# Land mask of the grid without the on disk cache, so the mask is computed from the Natural Earth polygons every time
+def suite_create_land_mask(n_lat, n_lon):
+    create_land_mask(xr.Dataset(coords={'lat':np.linspace(-90, 90, n_lat), 'lon':np.arange(n_lon) * 360 / n_lon}), cache_dir=False)
+
+# Time open_and_process, emd_means, euclidean_kmeans, precomputed_clusters and create_land_mask on synthetic multi-file datasets of every size in sizes,
+# each in a fresh process, reporting throughput in histograms (grid points for create_land_mask) per second and peak memory. Files and clusterings
+# are seeded, so runs with the same arguments do the same work and can be compared with compare_benchmark_reports once saved to report_path
+def benchmark_suite(sizes=None, k=6, emd_max_iter=5, kmeans_max_iter=50, seed=0, directory=None, report_path=None):
+    sizes = sizes or suite_sizes
+    directory = directory or tempfile.mkdtemp()
+    report = {'hostname':socket.gethostname(), 'num_threads':default_num_threads(), 'k':k, 'emd_max_iter':emd_max_iter, 'kmeans_max_iter':kmeans_max_iter, 'seed':seed, 'sizes':{}}
+
+    for name, size in sizes.items():
+        size_directory = os.path.join(directory, f'size_{len(report["sizes"])}')
+        data_path = write_synthetic_files(size_directory, size['n_files'], size.get('n_time', 1), size['n_lat'], size['n_lon'], seed, size['n_tau'], size['n_pc'])
+        index_path = os.path.join(size_directory, '.file_index.json')
+        mat_path = os.path.join(size_directory, 'mat.npy')
+        n1, n2 = size['n_tau'], size['n_pc']
+        results = {}
+
+        results['open_and_process'] = run_in_subprocess(suite_open_and_process, data_path, index_path)
+        mat = suite_open_and_process(data_path, index_path)
+        np.save(mat_path, mat)
+        n = len(mat)
+        del mat
+        results['open_and_process']['count'] = n
+
+        for stage, func, args, count in [('emd_means', suite_emd_means, (k, n1, n2, emd_max_iter, seed), n),
+                                         ('euclidean_kmeans', suite_euclidean_kmeans, (k, kmeans_max_iter, seed), n),
+                                         ('precomputed_clusters', suite_precomputed_clusters, (k, n1, n2, seed), n)]:
+            results[stage] = run_in_subprocess(func, *args, mat_path=mat_path)
+            results[stage]['count'] = count
+
+        try:
+            results['create_land_mask'] = run_in_subprocess(suite_create_land_mask, size['n_lat'], size['n_lon'])
+            results['create_land_mask']['count'] = size['n_lat'] * size['n_lon']
+        # The Natural Earth land polygons are downloaded by cartopy on first use
+        except Exception as e:
+            print(f"{'create_land_mask':>20}: skipped, {e}")
+
+        print(f'{name}: {n} histograms of {n1 * n2} bins')
+        for stage, result in results.items():
+            result['count_per_second'] = result['count'] / result['seconds']
+            print(f"{stage:>20}: {result['seconds']:7.2f} seconds, {result['count_per_second']:10.0f} per second, peak RSS {result['peak_rss_mb']:7.0f} MB "
+                  f"({result['peak_rss_mb'] - result['baseline_rss_mb']:+.0f} MB)")
+        report['sizes'][name] = {'size':size, 'n_histograms':n, 'results':results}
+
+    if report_path is not None:
+        with open(report_path, 'w') as f: json.dump(report, f, indent=1)
+    return report
+
+# Print the change in throughput and peak memory of every stage between two reports written by benchmark_suite
+def compare_benchmark_reports(reference_path, report_path):
+    with open(reference_path) as f: reference = json.load(f)
+    with open(report_path) as f: report = json.load(f)
+    for name in report['sizes']:
+        if name not in reference['sizes']: continue
+        print(f'{name}:')
+        for stage, result in report['sizes'][name]['results'].items():
+            if stage not in reference['sizes'][name]['results']: continue
+            reference_result = reference['sizes'][name]['results'][stage]
+            print(f"{stage:>20}: {result['count_per_second'] / reference_result['count_per_second']:5.2f}x throughput, "
+                  f"peak RSS {result['peak_rss_mb'] - reference_result['peak_rss_mb']:+6.0f} MB")
+
+if __name__ == "__main__":
+    lgr.root.setLevel('WARNING')
+    benchmark_event_memory()
+    benchmark_thread_scaling()
+    benchmark_open()
+    benchmark_coreset()
+    benchmark_coreset(n=2 * 10**4, coreset_size=2000, wasserstein_or_euclidean="wasserstein", n_init=1, tol=1e-3)
+    benchmark_dtypes()
+    benchmark_dtypes(n=10**5, wasserstein_or_euclidean="euclidean", tol=1e-4, max_iter=300)
+    benchmark_rendering()
+    benchmark_suite(report_path='benchmark_suite.json')
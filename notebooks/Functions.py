@@ -3,156 +3,563 @@ import logging as lgr
 # Silencing matplotlib and numba logs
 lgr.getLogger('matplotlib').setLevel(lgr.WARNING)
 lgr.getLogger('numba').setLevel(lgr.WARNING)
-from time import perf_counter
+from time import perf_counter, process_time
 import numpy as np
 try : import wasserstein
 except: 
     print('Wasserstein package is not installed so wasserstein distance cannot be used. Attempting to use wassertein distance will raise an error.')
     print('To use wasserstein distance please install the wasserstein package in your environment: https://pypi.org/project/Wasserstein/ ')
+    print('Alternatively, set emd_backend = "sinkhorn" to use the approximate wasserstein distance built into this file')
     print()
 import matplotlib.pyplot as plt
 from scipy import sparse
 import xarray as xr
+import pandas as pd
 import matplotlib as mpl
-from numba import njit
-from sklearn.cluster import KMeans
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from sklearn.cluster import KMeans, kmeans_plusplus
 from cartopy.mpl.ticker import LongitudeFormatter, LatitudeFormatter
 import cartopy.crs as ccrs
 import cartopy
 import glob
 from math import ceil
-from shapely.geometry import Point
-from shapely.prepared import prep
+import shapely
 import dask
+import dask.array
+import netCDF4
+import os
+import mmap
+import json
+import shutil
+import hashlib
+from datetime import datetime
+from dataclasses import dataclass, field
+from functools import partial
+from contextlib import contextmanager
+import inspect
+import socket
+try: import resource
+except ImportError: resource = None
+from threadpoolctl import threadpool_limits
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
 #%%
 # Avoid creation of large chunks with dask
 dask.config.set({"array.slicing.split_large_chunks": False})
 
-# Open data, process into an (n_observation, n_dims) matrix for clustering, cluster and or create cluster labels, and return them
-def open_and_process(data_path, k, tol, max_iter, init, n_init, var_name, tau_var_name, ht_var_name, lat_var_name, lon_var_name, height_or_pressure, wasserstein_or_euclidean = "euclidean", premade_cloud_regimes=None, lat_range=None, lon_range=None, time_range=None, only_ocean_or_land=False, land_frac_var_name=None, cluster=True, gpu=False):
-    # Getting files
-    files = glob.glob(data_path)
-    # Opening an initial dataset
-    init_ds = xr.open_mfdataset(files[0])
-    # Creating a list of all the variables in the dataset
-    remove = list(init_ds.keys())
-    # Deleting the variables we want to keep in our dataset, all remaining variables will be dropped upon opening the files, this allows for faster opening of large files
-    remove.remove(var_name)
-    # If land_frac_var_name is a string, take it out of the variables to be dropped upon opening files. If it has been entered incorrectly inform the user and proceed with TODO
-    if land_frac_var_name != None:
-        try: remove.remove(land_frac_var_name)
-        except: 
-            land_frac_var_name = None
-            print(f'{land_frac_var_name} variable does not exist, make sure land_frac_var_name is set correctly. Using TODO for land mask')
+# Number of CPUs this process is allowed to run on, which can be fewer than the number of CPUs on the node in batch jobs
+def default_num_threads():
+    try: return len(os.sched_getaffinity(0))
+    except AttributeError: return os.cpu_count()
+
+# Runtime settings shared by all of the clustering functions: number of threads to use, random number generator, and floating point type for the EMD calculations
+# Ex. RuntimeConfig(num_threads=32, rng=np.random.default_rng(42)) for reproducible results using 32 threads
+@dataclass
+class RuntimeConfig:
+    num_threads: int = field(default_factory=default_num_threads)
+    rng: np.random.Generator = field(default_factory=np.random.default_rng)
+    dtype: type = np.float32
+
+# Peak resident memory of this process so far in MB (ru_maxrss is in KB on linux), or None where the resource module is not available
+def peak_rss_mb():
+    if resource is None: return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# Current resident memory of this process in MB, or None where /proc is not available
+def current_rss_mb():
+    try:
+        with open('/proc/self/statm') as f: return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024**2
+    except (OSError, ValueError): return None
+
+# Record of the stages of a run, filled in by span while record_run is active. Every span records its wall time, the CPU time of the process (all threads),
+# the change in resident memory of the process over the span, the peak resident memory of the whole process so far when it ended (not the peak within the span),
+# and the number of items it processed if that was given
+@dataclass
+class RunReport:
+    metadata: dict = field(default_factory=dict)
+    spans: list = field(default_factory=list)
+    stack: list = field(default_factory=list)
+    started: float = field(default_factory=perf_counter)
+    started_cpu: float = field(default_factory=process_time)
+    started_at: str = field(default_factory=lambda: datetime.now().isoformat())
+
+    # Totals over every span with the same name, and the throughput of the spans that counted their items
+    def summary(self):
+        summary = {}
+        for record in self.spans:
+            total = summary.setdefault(record['name'], {'calls':0, 'wall_seconds':0.0, 'cpu_seconds':0.0, 'count':None, 'max_rss_change_mb':None, 'process_peak_rss_mb':None})
+            total['calls'] += 1
+            total['wall_seconds'] += record['wall_seconds']
+            total['cpu_seconds'] += record['cpu_seconds']
+            if record['count'] is not None: total['count'] = (total['count'] or 0) + record['count']
+            for key, value in [('max_rss_change_mb', record['rss_change_mb']), ('process_peak_rss_mb', record['process_peak_rss_mb'])]:
+                if value is not None: total[key] = value if total[key] is None else max(total[key], value)
+        for total in summary.values():
+            if total['count'] is not None and total['wall_seconds'] > 0: total['count_per_second'] = total['count'] / total['wall_seconds']
+        return summary
+
+    def to_dict(self):
+        return {'metadata':self.metadata, 'started_at':self.started_at, 'hostname':socket.gethostname(), 'pid':os.getpid(), 'num_threads':default_num_threads(),
+                'wall_seconds':perf_counter() - self.started, 'cpu_seconds':process_time() - self.started_cpu, 'process_peak_rss_mb':peak_rss_mb(),
+                'summary':self.summary(), 'spans':self.spans}
+
+# The RunReport that spans are added to, set by record_run
+active_report = None
+
+# Time a stage of the pipeline, as a context manager (with span('stack', count=n_histograms): ...) or as a decorator (@span('emd_means')), and log how long it took
+# as "seconds to message", or "seconds in name" without a message. The yielded dictionary can be given the count or message after the stage has run, as in record['count'] = len(mat)
+# While record_run is active the span is also added to its report, nested by name. Work done in worker processes, for example with n_jobs > 1, is not recorded
+@contextmanager
+def span(name, count=None, message=None):
+    report = active_report
+    record = {'name':name, 'count':count}
+    if report is not None:
+        record['path'] = '/'.join(report.stack + [name])
+        report.stack.append(name)
+        rss = current_rss_mb()
+    wall, cpu = perf_counter(), process_time()
+    try: yield record
+    finally:
+        seconds = perf_counter() - wall
+        message = record.pop('message', message)
+        lgr.info(f' {round(seconds, 2)} seconds to {message}:' if message != None else f' {round(seconds, 2)} seconds in {name}:')
+        if report is not None:
+            end_rss = current_rss_mb()
+            record.update(start_seconds=wall - report.started, wall_seconds=seconds, cpu_seconds=process_time() - cpu,
+                          rss_change_mb=end_rss - rss if end_rss is not None and rss is not None else None, process_peak_rss_mb=peak_rss_mb())
+            report.spans.append(record)
+            report.stack.pop()
+
+# Record the spans of everything run inside the with block, and write them to report_path as JSON when the block ends, even if it raised
+# metadata, for example the arguments of the run, is stored with the report. Ex. with record_run('report.json', k=k): open_and_process(...)
+@contextmanager
+def record_run(report_path=None, **metadata):
+    global active_report
+    previous = active_report
+    active_report = report = RunReport(metadata=metadata)
+    try: yield report
+    finally:
+        active_report = previous
+        if report_path != None:
+            with open(report_path + f'.tmp{os.getpid()}', 'w') as f: json.dump(report.to_dict(), f, indent=1, default=str)
+            os.replace(report_path + f'.tmp{os.getpid()}', report_path)
+
+# Orient stage of open_and_preprocess: adjust lon to run from -180 to 180 if it doesnt already
+# The height/pressure axis is left in the order it is stored in, which is what the plotting functions expect
+def orient_histograms(ds, lon_var_name):
+    lons = ds[lon_var_name].values
+    if np.max(lons) > 180: 
+        lons = (lons + 180) % 360 - 180
+        order = np.argsort(lons, kind='stable')
+        ds = ds.isel({lon_var_name:order}).assign_coords({lon_var_name:lons[order]})
+    return ds
+
+# Subset stage of open_and_preprocess: select the lat, lon and time ranges and the valid tau and height/pressure bins
+# lon_range is in -180 to 180 longitudes, and can be selected before or after orient_histograms
+def subset_histograms(ds, tau_var_name, ht_var_name, lat_var_name, lon_var_name, lat_range=None, lon_range=None, time_range=None):
+    selection = {}
 
-    # Opening data
-    lgr.info(' Opening dataset:')
-    ds = xr.open_mfdataset(files, drop_variables = remove)
-
-    # Turning into a dataarray
-    lgr.info(' Opening finished. Beginning preprocessing:')
-    ds = ds[var_name]
-
-    # Adjusting lon to run from -180 to 180 if it doesnt already
-    if np.max(ds.lon) > 180: 
-        ds.coords['lon'] = (ds.coords['lon'] + 180) % 360 - 180
-        ds = ds.sortby(ds.lon)
-
-    # TODO MODIS has bogus values for pressure and tau in the coordinate variables, true values are listed as an attribute. This slice of code is still compatible with modis, but may not be compatible with another dataset that stores bogus coordinate values
-    # Reordering y dimension from lowest to graound to highest if it needs to be reordered
-    if height_or_pressure == 'h': 
-        if ds[ht_var_name][0] > ds[ht_var_name][-1]: 
-            ds.reindex({ht_var_name:ds[ht_var_name][::-1]})
-    if height_or_pressure == 'p':
-        if ds[ht_var_name][0] < ds[ht_var_name][-1]: 
-            ds.reindex({ht_var_name:ds[ht_var_name][::-1]})
-
-    # Selecting only points over ocean or points over land if only_ocean_or_land has been used
-    if only_ocean_or_land != False:
-
-        # Mask out land or water with LANDFRAC variable if we have it
-        if land_frac_var_name != None:
-            if only_ocean_or_land == 'L': ds = ds.where(ds[land_frac_var_name] == 1)
-            elif only_ocean_or_land == 'O': ds = ds.where(ds[land_frac_var_name] == 0)
-            else: raise Exception('Invalid option for only_ocean_or_land: Please enter "O" for ocean only, "L" for land only, or set to False for both land and water')
-
-        # Otherwise use cartopy
-        else:
-            # Creating land mask
-            oh_land = create_land_mask(ds)
-
-            # inserting new axis to make oh_land a broadcastable shape with ds
-            dims = ds.dims
-            for n in range(len(dims)):
-                if dims[n] != lat_var_name and dims[n] != lon_var_name:
-                    oh_land = np.expand_dims(oh_land, n)
-
-            # Masking out the land or water
-            if only_ocean_or_land == 'L': ds = ds.where(oh_land == 1)
-            elif only_ocean_or_land == 'O': ds = ds.where(oh_land == 0)
-            else: raise Exception('Invalid option for only_ocean_or_land: Please enter "O" for ocean only, "L" for land only, or set to False for both land and water')
-        
     # Selecting lat range
-    if lat_range is not None:
-        lat_selection = {lat_var_name:slice(np.min(lat_range),np.max(lat_range))}
-        ds = ds.sel(lat_selection)
-    # if lat_range != None:
-    #     if ds[lat_var_name][0] > ds[lat_var_name][-1]:
-    #         lat_selection = {lat_var_name:slice(lat_range[1],lat_range[0])}
-    #         ds = ds.sel(lat_selection)
-    #     else:
-    #         lat_selection = {lat_var_name:slice(lat_range[0],lat_range[1])}
-    #         ds = ds.sel(lat_selection)
-
-    # Selecting Lon range
+    if lat_range is not None: selection[lat_var_name] = slice(np.min(lat_range),np.max(lat_range))
+
+    # Selecting Lon range, comparing against the longitudes the points will have once they have been oriented to run from -180 to 180
     if lon_range is not None:
-        lon_selection = {lon_var_name:slice(np.min(lon_range),np.max(lon_range))}
-        ds = ds.sel(lon_selection)
-    # if lon_range != None:
-    #     if ds[lon_var_name][0] > ds[lon_var_name][-1]:
-    #         lon_selection = {lon_var_name:slice(lon_range[1],lon_range[0])}
-    #         ds = ds.sel(lon_selection)
-    #     else:
-    #         lon_selection = {lon_var_name:slice(lon_range[0],lon_range[1])}
-    #         ds = ds.sel(lon_selection)
+        lons = ds[lon_var_name].values
+        if np.max(lons) > 180: lons = (lons + 180) % 360 - 180
+        ds = ds.isel({lon_var_name:np.flatnonzero((lons >= np.min(lon_range)) & (lons <= np.max(lon_range)))})
 
     # Selecting time range
-    if time_range != None:
-        ds = ds.sel(time=slice(time_range[0],time_range[1]))
+    if time_range != None: selection['time'] = slice(time_range[0],time_range[1])
 
     # Selecting only valid tau and height/pressure range
     # Many data products have a -1 bin for failed retreivals, we do not wish to include this
-    tau_selection = {tau_var_name:slice(0,None)}
+    selection[tau_var_name] = slice(0,None)
     # Making sure this works for pressure which is ordered largest to smallest and altitude which is ordered smallest to largest
-    if ds[ht_var_name][0] > ds[ht_var_name][-1]: ht_selection = {ht_var_name:slice(None,0)}
-    else: ht_selection = {ht_var_name:slice(0,None)}
-    ds = ds.sel(tau_selection)
-    ds = ds.sel(ht_selection)
+    ht = ds[ht_var_name].values
+    if ht[0] > ht[-1]: selection[ht_var_name] = slice(None,0)
+    else: selection[ht_var_name] = slice(0,None)
 
-    # Selcting only the relevant data and stacking it to shape n_histograms, n_tau * n_pc
-    lgr.info(' Reshaping data to shape (n_histograms, n_tau_bins* n_pc_bins):')
-    dims = list(ds.dims)
-    dims.remove(tau_var_name)
-    dims.remove(ht_var_name)
-    histograms = ds.stack(spacetime=(dims), tau_ht=(tau_var_name, ht_var_name))
-    weights = np.cos(np.deg2rad(histograms[lat_var_name].values)) # weights array to use with emd-kmeans
+    return ds.sel(selection)
 
-    # Turning into a numpy array for clustering
-    lgr.info(' Reading data into memory:')
-    mat = histograms.values
+# Per file part of open_and_preprocess, passed to xr.open_mfdataset as preprocess= so the subset stage is applied to every file before they are combined
+# and data outside of the selection is never read. The time selection is applied after combining, as some files may contain no times in time_range
+def preprocess_file(ds, keep_variables, tau_var_name, ht_var_name, lat_var_name, lon_var_name, lat_range=None, lon_range=None):
+    ds = ds[keep_variables]
+    ds = subset_histograms(ds, tau_var_name, ht_var_name, lat_var_name, lon_var_name, lat_range, lon_range)
+    return ds
 
-    # Removing all histograms with 1 or more nans in them
-    indicies = np.arange(len(mat))
-    is_valid = ~np.isnan(mat.mean(axis=1))
-    is_valid = is_valid.astype(np.int32)
-    valid_indicies = indicies[is_valid==1]
-    mat=mat[valid_indicies]
-    weights=weights[valid_indicies]
+# Mask stage of open_and_preprocess: select only points over ocean or points over land
+def mask_land_or_ocean(ds, var_name, lat_var_name, lon_var_name, only_ocean_or_land, land_frac_var_name=None):
+    if only_ocean_or_land not in ['L', 'O']: raise Exception('Invalid option for only_ocean_or_land: Please enter "O" for ocean only, "L" for land only, or set to False for both land and water')
+
+    # Mask out land or water with LANDFRAC variable if we have it
+    if land_frac_var_name != None:
+        if only_ocean_or_land == 'L': return ds[var_name].where(ds[land_frac_var_name] == 1)
+        return ds[var_name].where(ds[land_frac_var_name] == 0)
+
+    # Otherwise use cartopy, creating the land mask only on the selected grid
+    oh_land = xr.DataArray(create_land_mask(ds, lat_var_name, lon_var_name), dims=(lat_var_name, lon_var_name))
+    if only_ocean_or_land == 'L': return ds[var_name].where(oh_land == 1)
+    return ds[var_name].where(oh_land == 0)
+
+# Read the variables, dimension sizes and time range of a single file for the file index
+def read_file_metadata(file):
+    with xr.open_dataset(file, decode_times=True) as ds:
+        metadata = {'variables':{name:{'dims':list(ds[name].dims), 'itemsize':ds[name].dtype.itemsize} for name in ds.data_vars}, 'sizes':dict(ds.sizes), 'time':None}
+        if 'time' in ds.coords and np.issubdtype(ds['time'].dtype, np.datetime64) and ds.sizes['time'] > 0:
+            metadata['time'] = [str(ds['time'].values.min()), str(ds['time'].values.max())]
+    return metadata
+
+# Index of the files in an archive, with the variables, dimension sizes and time range of every file, kept in a JSON sidecar at index_path
+# (.file_index.json in the directory of the files by default) so later opens don't have to scan every file. Entries are reused while a file's size and
+# modification time are unchanged, and new or changed files are read num_threads at a time
+def build_file_index(files, index_path=None, num_threads=None):
+    if index_path is None: index_path = os.path.join(os.path.commonpath([os.path.dirname(os.path.abspath(file)) for file in files]), '.file_index.json')
+    if num_threads is None: num_threads = default_num_threads()
+
+    index = {}
+    if os.path.isfile(index_path):
+        try:
+            with open(index_path) as f: index = json.load(f)
+        except ValueError: lgr.warning(f' Could not read file index {index_path}, rebuilding it')
+
+    # Finding which files are new or have changed since they were indexed
+    stats = {os.path.abspath(file):os.stat(file) for file in files}
+    stale = [file for file, stat in stats.items() if file not in index or index[file]['size'] != stat.st_size or index[file]['mtime'] != stat.st_mtime_ns]
+    if len(stale) > 0:
+        lgr.info(f' Indexing {len(stale)} of {len(files)} files:')
+        with ThreadPoolExecutor(max(1, min(num_threads, len(stale)))) as executor:
+            for file, metadata in zip(stale, executor.map(read_file_metadata, stale)):
+                index[file] = {**metadata, 'size':stats[file].st_size, 'mtime':stats[file].st_mtime_ns}
+        try:
+            with open(index_path + f'.tmp{os.getpid()}', 'w') as f: json.dump(index, f)
+            os.replace(index_path + f'.tmp{os.getpid()}', index_path)
+        except OSError: lgr.warning(f' Could not write file index to {index_path}, files will be scanned again next time')
+
+    return {os.path.abspath(file):index[os.path.abspath(file)] for file in files}
+
+# Chunking policy for opening histogram files: whole histograms and whole lat/lon grids in every chunk, so stacking into spacetime and tau_ht never splits or
+# merges chunks, and as many time steps per chunk as fit in chunk_bytes. file_metadata is a file index entry from build_file_index
+def histogram_chunks(file_metadata, var_name, chunk_bytes=2**27):
+    dims = file_metadata['variables'][var_name]['dims']
+    sizes = file_metadata['sizes']
+    step_bytes = file_metadata['variables'][var_name]['itemsize'] * int(np.prod([sizes[dim] for dim in dims if dim != 'time']))
+    chunks = {dim:-1 for dim in dims}
+    if 'time' in dims: chunks['time'] = int(max(1, min(sizes['time'], chunk_bytes // step_bytes)))
+    return chunks
+
+# Open data and lazily apply all selections and masks, returning a DataArray ready to be stacked into histograms
+# Files are listed from a cached file index (see build_file_index), files entirely outside of time_range are never opened, and the rest are opened in parallel
+# The stages run in the order open (with per file variable pruning and subsetting) -> orient -> time subset -> mask, and nothing is computed until the
+# stacked histograms are read into memory by the caller
+@span('open_and_preprocess')
+def open_and_preprocess(data_path, var_name, tau_var_name, ht_var_name, lat_var_name, lon_var_name, height_or_pressure, lat_range=None, lon_range=None, time_range=None, only_ocean_or_land=False, land_frac_var_name=None, parallel=True, index_path=None, chunk_bytes=2**27):
+    # Getting files
+    files = sorted(glob.glob(data_path))
+    if len(files) == 0: raise Exception (f'No files found matching {data_path}')
+    with span('index_files', count=len(files), message=f'index {len(files)} files'):
+        file_index = build_file_index(files, index_path)
+
+    # Skipping files that have no times in time_range
+    if time_range != None:
+        start, stop = np.datetime64(time_range[0]), np.datetime64(time_range[1])
+        files = [file for file in files if file_index[os.path.abspath(file)]['time'] == None
+                 or (np.datetime64(file_index[os.path.abspath(file)]['time'][0]) <= stop and np.datetime64(file_index[os.path.abspath(file)]['time'][1]) >= start)]
+        if len(files) == 0: raise Exception (f'No files in {data_path} contain times in time_range')
+
+    # Creating a list of all the variables in the dataset
+    first_file = file_index[os.path.abspath(files[0])]
+    remove = list(first_file['variables'])
+    # Deleting the variables we want to keep in our dataset, all remaining variables will be dropped upon opening the files, this allows for faster opening of large files
+    remove.remove(var_name)
+    # If land_frac_var_name is a string, take it out of the variables to be dropped upon opening files. If it has been entered incorrectly inform the user and proceed with a cartopy land mask
+    if land_frac_var_name != None:
+        try: remove.remove(land_frac_var_name)
+        except: 
+            print(f'{land_frac_var_name} variable does not exist, make sure land_frac_var_name is set correctly. Using cartopy for land mask')
+            land_frac_var_name = None
+    keep_variables = [var_name] if land_frac_var_name == None else [var_name, land_frac_var_name]
+
+    # Opening data, subsetting every file as it is opened
+    lgr.info(' Opening dataset:')
+    preprocess = partial(preprocess_file, keep_variables=keep_variables, tau_var_name=tau_var_name, ht_var_name=ht_var_name, lat_var_name=lat_var_name, lon_var_name=lon_var_name, lat_range=lat_range, lon_range=lon_range)
+    chunks = histogram_chunks(first_file, var_name, chunk_bytes)
+    # If the index knows the time range of every file, the files are concatenated in time order without reading and comparing all of their coordinates
+    if all(file_index[os.path.abspath(file)]['time'] != None for file in files):
+        files = sorted(files, key=lambda file: np.datetime64(file_index[os.path.abspath(file)]['time'][0]))
+        combine = dict(combine='nested', concat_dim='time', data_vars='minimal', coords='minimal', compat='override')
+    else: combine = dict(combine='by_coords')
+    with span('open_files', count=len(files), message=f'open and subset {len(files)} files'):
+        ds = xr.open_mfdataset(files, drop_variables = remove, preprocess = preprocess, parallel = parallel, chunks = chunks, **combine)
+
+    # Orienting the combined data and selecting time range
+    with span('orient_and_subset', message='orient and select time range'):
+        ds = orient_histograms(ds, lon_var_name)
+        ds = subset_histograms(ds, tau_var_name, ht_var_name, lat_var_name, lon_var_name, time_range=time_range)
+
+    # Masking out land or water if only_ocean_or_land has been used, and turning into a dataarray
+    with span('mask', message='mask'):
+        if only_ocean_or_land != False: ds = mask_land_or_ocean(ds, var_name, lat_var_name, lon_var_name, only_ocean_or_land, land_frac_var_name)
+        else: ds = ds[var_name]
+
+    return ds
+
+# Remove all histograms with 1 or more nans in them, and check that the remaining data is valid
+def filter_valid_histograms(mat, weights, var_name):
+    valid_indicies = np.flatnonzero(~np.isnan(mat.mean(axis=1)))
+    mat = mat[valid_indicies]
+    weights = weights[valid_indicies]
 
     # Safetey check that shouldnt really be necesary
     if np.any(mat < 0):
         raise Exception (f'Found negative value in ds.{var_name}, if this is a fill value for missing data, convert to nans and try again')
-    
+
+    return mat, valid_indicies, weights
+
+# Convert mat to mat_dtype for clustering. Floating point types are a plain conversion. Unsigned integer types pack the histograms as codes that are multiplied by
+# scale_factor to get the histograms back, like a packed NetCDF variable, using a quarter (uint8) or half (uint16) of the memory of float32
+# scale_factor defaults to the largest value in mat divided by the largest code, so the whole range of mat_dtype is used. Returns the converted mat and scale_factor
+def quantize_histograms(mat, mat_dtype=np.uint8, scale_factor=None, block_size=2**20):
+    if np.issubdtype(mat_dtype, np.floating): return np.asarray(mat, dtype=mat_dtype), 1.0
+    if not np.issubdtype(mat_dtype, np.unsignedinteger): raise Exception (f'mat_dtype must be a floating point or unsigned integer type. You entered {mat_dtype}')
+    max_code = np.iinfo(mat_dtype).max
+    if scale_factor is None: scale_factor = float(np.max(mat)) / max_code or 1.0
+    codes = np.empty(mat.shape, dtype=mat_dtype)
+    for start in range(0, len(mat), block_size):
+        codes[start:start + block_size] = np.clip(np.rint(mat[start:start + block_size] / scale_factor), 0, max_code)
+    return codes, scale_factor
+
+# Unpack histograms packed by quantize_histograms into dtype
+def dequantize_histograms(codes, scale_factor, dtype=np.float32):
+    return codes.astype(dtype) * dtype(scale_factor)
+
+# Key identifying a preprocessing result: a hash of the data files (paths, sizes and modification times) and of every argument that changes the preprocessing
+def preprocessing_cache_key(files, **selection):
+    hash = hashlib.sha256()
+    for file in sorted(files):
+        stat = os.stat(file)
+        hash.update(f'{os.path.abspath(file)}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+    hash.update(json.dumps(selection, sort_keys=True, default=str).encode())
+    return hash.hexdigest()[:32]
+
+# Delete the least recently used entries of the preprocessing cache until it takes up no more than cache_max_bytes, never deleting the entry named keep
+# Entries used in the last min_idle seconds are never deleted either, as another process may be loading or still writing them
+def evict_preprocessing_cache(cache_dir, cache_max_bytes, keep=None, min_idle=600):
+    entries = []
+    for key in os.listdir(cache_dir):
+        metadata_path = os.path.join(cache_dir, key, 'metadata.json')
+        if not os.path.isfile(metadata_path): continue
+        with open(metadata_path) as f: metadata = json.load(f)
+        entries.append((metadata['last_used'], metadata['nbytes'], key))
+
+    now = datetime.now().timestamp()
+    total = sum(entry[1] for entry in entries)
+    for last_used, nbytes, key in sorted(entries):
+        if total <= cache_max_bytes: break
+        if key == keep or now - last_used < min_idle: continue
+        lgr.info(f' Evicting {key} from the preprocessing cache')
+        shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+        total -= nbytes
+
+# Save the output of the preprocessing in open_and_process to cache_dir/key: mat, valid_indicies and weights as .npy files, the coordinates of the stacked
+# spacetime and tau_ht dimensions, and a metadata.json sidecar with the dimensions of ds, so the opened data can be rebuilt without opening the files.
+# The entry is written to a temporary directory first so a partially written entry is never read
+def save_preprocessing_cache(cache_dir, key, mat, valid_indicies, weights, ds, histograms, metadata, cache_max_bytes=50e9):
+    entry = os.path.join(cache_dir, key)
+    temp = entry + f'.tmp{os.getpid()}'
+    os.makedirs(temp, exist_ok=True)
+    np.save(os.path.join(temp, 'mat.npy'), mat)
+    np.save(os.path.join(temp, 'valid_indicies.npy'), valid_indicies)
+    np.save(os.path.join(temp, 'weights.npy'), weights)
+
+    # The spacetime and tau_ht indexes are the products of the coordinates of their stacked dimensions, in this order
+    dims = list(histograms.indexes['spacetime'].names)
+    bin_dims = list(histograms.indexes['tau_ht'].names)
+    np.savez(os.path.join(temp, 'index.npz'), **{dim:histograms[dim].to_index().unique().values for dim in dims + bin_dims})
+
+    now = datetime.now().timestamp()
+    metadata = {**metadata, 'key':key, 'dims':dims, 'bin_dims':bin_dims, 'ds_dims':list(ds.dims), 'name':ds.name, 'ds_dtype':ds.dtype.str, 'attrs':dict(ds.attrs),
+                'n_histograms':histograms.sizes['spacetime'], 'shape':list(mat.shape), 'dtype':mat.dtype.str,
+                'nbytes':sum(os.path.getsize(os.path.join(temp, f)) for f in os.listdir(temp)), 'created':now, 'last_used':now}
+    with open(os.path.join(temp, 'metadata.json'), 'w') as f: json.dump(metadata, f, indent=1, default=str)
+
+    shutil.rmtree(entry, ignore_errors=True)
+    os.replace(temp, entry)
+    evict_preprocessing_cache(cache_dir, cache_max_bytes, keep=key)
+
+# Lazily rebuild the stacked histograms of a preprocessing cache entry from its matrix, one block of spacetime at a time, without opening the data files
+# Histograms that were filtered out as invalid are nan, as they were in the opened data, and quantized matricies are unpacked with scale_factor
+def cached_histograms(mat, valid_indicies, scale_factor, index, metadata, block_size=2**16):
+    dims, bin_dims = metadata['dims'], metadata['bin_dims']
+    n, d = metadata['n_histograms'], mat.shape[1]
+    dtype = np.dtype(metadata['ds_dtype'])
+
+    def block(block_info=None):
+        (start, stop), _ = block_info[None]['array-location']
+        values = np.full((stop - start, d), np.nan, dtype=dtype)
+        first, last = np.searchsorted(valid_indicies, [start, stop])
+        rows = np.asarray(mat[first:last])
+        if np.issubdtype(rows.dtype, np.integer): rows = dequantize_histograms(rows, scale_factor, dtype.type)
+        values[valid_indicies[first:last] - start] = rows
+        return values
+
+    chunks = (tuple(min(block_size, n - start) for start in range(0, n, block_size)), (d,))
+    data = dask.array.map_blocks(block, chunks=chunks, dtype=dtype, meta=np.array((), dtype=dtype))
+    coords = xr.Coordinates.from_pandas_multiindex(pd.MultiIndex.from_product([index[dim] for dim in dims], names=dims), 'spacetime')
+    coords = coords.merge(xr.Coordinates.from_pandas_multiindex(pd.MultiIndex.from_product([index[dim] for dim in bin_dims], names=bin_dims), 'tau_ht')).coords
+    return xr.DataArray(data, dims=('spacetime', 'tau_ht'), coords=coords, name=metadata['name'])
+
+# Hard link the matrix of a preprocessing cache entry saved at npy_path to path, with the path + ".json" sidecar of write_histogram_memmap, and return it as a read only
+# np.memmap. The link keeps the matrix on disk when the cache entry is evicted. Where a hard link is not possible, e.g. across file systems, the matrix is copied instead
+def link_histogram_memmap(npy_path, path, scale_factor=None):
+    with open(npy_path, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0): shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else: shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if fortran_order: raise Exception (f'{npy_path} is not stored in C order and cannot be opened as a histogram memmap')
+
+    temp = path + f'.tmp{os.getpid()}'
+    if os.path.exists(temp): os.remove(temp)
+    try: os.link(npy_path, temp)
+    except OSError: shutil.copyfile(npy_path, temp)
+    os.replace(temp, path)
+    with open(path + '.json', 'w') as f: json.dump({'shape':list(shape), 'dtype':dtype.str, 'scale_factor':scale_factor, 'offset':offset}, f)
+
+    return open_histogram_memmap(path)
+
+# Load mat, valid_indicies, weights and the scale_factor of a quantized mat from cache_dir/key if they were cached, along with ds and its stacked histograms rebuilt
+# lazily from the cached matrix (see cached_histograms), so none of the data files have to be opened. Otherwise returns None
+# If memmap_path is set, the cached matrix is linked there with link_histogram_memmap and returned as a np.memmap of memmap_path, otherwise it is read into memory,
+# so the returned matrix never depends on the cache entry staying on disk. An entry deleted by another process while it is loaded is treated as missing
+# The key already changes whenever a file or an argument of the preprocessing does, so the entry is only checked to be complete
+def load_preprocessing_cache(cache_dir, key, memmap_path=None):
+    entry = os.path.join(cache_dir, key)
+    metadata_path = os.path.join(entry, 'metadata.json')
+    if not os.path.isfile(metadata_path): return None
+    try:
+        with open(metadata_path) as f: metadata = json.load(f)
+
+        index = np.load(os.path.join(entry, 'index.npz'), allow_pickle=True)
+        if 'ds_dims' not in metadata or metadata['n_histograms'] != int(np.prod([len(index[dim]) for dim in metadata['dims']])):
+            lgr.warning(f' Cached preprocessing {key} is incomplete or from an older version, recomputing it')
+            return None
+
+        scale_factor = metadata.get('scale_factor', 1.0)
+        if memmap_path != None: mat = link_histogram_memmap(os.path.join(entry, 'mat.npy'), memmap_path, scale_factor)
+        else: mat = np.load(os.path.join(entry, 'mat.npy'))
+        valid_indicies = np.load(os.path.join(entry, 'valid_indicies.npy'))
+        weights = np.load(os.path.join(entry, 'weights.npy'))
+        index = {dim:index[dim] for dim in metadata['dims'] + metadata['bin_dims']}
+    except FileNotFoundError:
+        lgr.warning(f' Cached preprocessing {key} was deleted while it was loaded, recomputing it')
+        return None
+    histograms = cached_histograms(mat, valid_indicies, scale_factor, index, metadata)
+    ds = histograms.unstack().transpose(*metadata['ds_dims'])
+    ds.attrs.update(metadata['attrs'])
+
+    # Written to a temporary file first so other processes loading or evicting this entry never read a partially written metadata.json
+    metadata['last_used'] = datetime.now().timestamp()
+    with open(metadata_path + f'.tmp{os.getpid()}', 'w') as f: json.dump(metadata, f, indent=1, default=str)
+    os.replace(metadata_path + f'.tmp{os.getpid()}', metadata_path)
+
+    return mat, valid_indicies, weights, scale_factor, ds, histograms
+
+# Write the (mat, valid_indicies, weights) blocks yielded by iter_histogram_blocks to a raw file at path, one block at a time, and return the matrix as a read only np.memmap
+# The shape and dtype are written to a path + ".json" sidecar so other processes can open the same file with open_histogram_memmap
+# Unsigned integer dtypes are packed with quantize_histograms using scale_factor, which has to be given as the blocks are written before all of the data has been seen
+def write_histogram_memmap(path, blocks, dtype=np.float32, scale_factor=None):
+    valid_indicies, weights = [], []
+    n_histograms, n_bins = 0, None
+    with open(path + f'.tmp{os.getpid()}', 'wb') as f:
+        for start, stop, mat, valid_indicies_block, weights_block in blocks:
+            f.write(np.ascontiguousarray(quantize_histograms(mat, dtype, scale_factor)[0]).tobytes())
+            n_histograms += len(mat)
+            n_bins = mat.shape[1]
+            valid_indicies.append(valid_indicies_block)
+            weights.append(weights_block)
+    os.replace(path + f'.tmp{os.getpid()}', path)
+    with open(path + '.json', 'w') as f: json.dump({'shape':[n_histograms, n_bins], 'dtype':np.dtype(dtype).str, 'scale_factor':scale_factor}, f)
+
+    return open_histogram_memmap(path), np.concatenate(valid_indicies), np.concatenate(weights)
+
+# Open a histogram matrix written by write_histogram_memmap or link_histogram_memmap as a read only np.memmap
+def open_histogram_memmap(path, mode='r'):
+    with open(path + '.json') as f: metadata = json.load(f)
+    return np.memmap(path, dtype=metadata['dtype'], mode=mode, shape=tuple(metadata['shape']), offset=metadata.get('offset', 0))
+
+# Open data, process into an (n_observation, n_dims) matrix for clustering, cluster and or create cluster labels, and return them
+# The matrix is returned as mat_dtype. float32 halves the memory of float64, and the EMDs are calculated in float32 anyway. uint8 and uint16 pack the histograms
+# with quantize_histograms, and the scale factor that turns mat back into histograms is stored in ds.attrs['mat_scale_factor']
+# If memmap_path is set, the matrix is written to that file block by block and returned as a np.memmap, so it never has to fit in memory and
+# processes working on it share one copy through the page cache. When the matrix comes from the preprocessing cache, the cached file is linked to memmap_path instead
+# If cache_dir is set, the preprocessed matrix is saved there and reused by later calls on the same, unchanged files with the same arguments. A reused result
+# does not open the files at all, ds and histograms are then rebuilt lazily from the cached matrix, with the precision of mat_dtype
+# The least recently used results are deleted when the cache grows past cache_max_bytes
+# If checkpoint_path is set, wasserstein clustering with emd_means is checkpointed there. With resume = True it resumes from that checkpoint if it exists
+# and was saved by a run on the same matrix with the same clustering arguments
+@span('open_and_process')
+def open_and_process(data_path, k, tol, max_iter, init, n_init, var_name, tau_var_name, ht_var_name, lat_var_name, lon_var_name, height_or_pressure, wasserstein_or_euclidean = "euclidean", premade_cloud_regimes=None, lat_range=None, lon_range=None, time_range=None, only_ocean_or_land=False, land_frac_var_name=None, cluster=True, gpu=False, batch_size=None, emd_backend="wasserstein", config=None, cache_dir=None, cache_max_bytes=50e9, memmap_path=None, mat_dtype=np.float32, scale_factor=None, parallel=True, index_path=None, checkpoint_path=None, resume=False):
+    # Looking for this data in the preprocessing cache before opening any of the files
+    cached = None
+    if cache_dir != None:
+        selection = dict(var_name=var_name, tau_var_name=tau_var_name, ht_var_name=ht_var_name, lat_var_name=lat_var_name, lon_var_name=lon_var_name, height_or_pressure=height_or_pressure,
+                         lat_range=lat_range, lon_range=lon_range, time_range=time_range, only_ocean_or_land=only_ocean_or_land, land_frac_var_name=land_frac_var_name,
+                         mat_dtype=np.dtype(mat_dtype).str, scale_factor=scale_factor)
+        cache_key = preprocessing_cache_key(glob.glob(data_path), **selection)
+        with span('load_cache', message='look for the data in the preprocessing cache'):
+            cached = load_preprocessing_cache(cache_dir, cache_key, memmap_path)
+
+    if cached is not None:
+        lgr.info(f' Loaded preprocessed data from cache {cache_key}:')
+        mat, valid_indicies, weights, scale_factor, ds, histograms = cached
+
+    else:
+        # Opening the data and applying selections and masks
+        ds = open_and_preprocess(data_path, var_name, tau_var_name, ht_var_name, lat_var_name, lon_var_name, height_or_pressure, lat_range, lon_range, time_range, only_ocean_or_land, land_frac_var_name, parallel=parallel, index_path=index_path)
+
+        # Selcting only the relevant data and stacking it to shape n_histograms, n_tau * n_pc
+        lgr.info(' Reshaping data to shape (n_histograms, n_tau_bins* n_pc_bins):')
+        dims = list(ds.dims)
+        dims.remove(tau_var_name)
+        dims.remove(ht_var_name)
+        with span('stack', message='stack'):
+            histograms = ds.stack(spacetime=(dims), tau_ht=(tau_var_name, ht_var_name))
+
+        if memmap_path != None:
+            # The blocks are quantized as they are written, so the scale factor has to be found from the whole dataset first
+            if np.issubdtype(mat_dtype, np.unsignedinteger) and scale_factor is None:
+                with span('find_scale_factor', message='find the scale factor to quantize with'):
+                    scale_factor = float(ds.max().values) / np.iinfo(mat_dtype).max or 1.0
+            lgr.info(f' Writing data to {memmap_path}:')
+            with span('write_memmap', message='compute, filter and write histograms') as record:
+                mat, valid_indicies, weights = write_histogram_memmap(memmap_path, iter_histogram_blocks(ds, var_name, tau_var_name, ht_var_name, lat_var_name), mat_dtype, scale_factor)
+                record['count'] = len(mat)
+
+        else:
+            weights = np.cos(np.deg2rad(histograms[lat_var_name].values)) # weights array to use with emd-kmeans
+
+            # Turning into a numpy array for clustering
+            lgr.info(' Reading data into memory:')
+            with span('materialize_values', count=histograms.sizes['spacetime'], message='compute histograms'):
+                mat = histograms.values
+
+            # Removing all histograms with 1 or more nans in them
+            with span('filter_invalid', message='filter invalid histograms') as record:
+                mat, valid_indicies, weights = filter_valid_histograms(mat, weights, var_name)
+                record['count'] = len(mat)
+
+            with span('convert_dtype', count=len(mat), message=f'convert histograms to {np.dtype(mat_dtype).name}'):
+                mat, scale_factor = quantize_histograms(mat, mat_dtype, scale_factor)
+
+    if scale_factor is None: scale_factor = 1.0
+    if cached is None and cache_dir != None:
+        with span('save_cache', message='save the preprocessed data to the cache'):
+            save_preprocessing_cache(cache_dir, cache_key, mat, valid_indicies, weights, ds, histograms, {'data_path':data_path, 'selection':selection, 'scale_factor':scale_factor}, cache_max_bytes)
+    ds.attrs['mat_scale_factor'] = scale_factor
+
     # If cluster is not true, then skip clustering and just return the oopened and preprocessed data
     lgr.info(' Finished preprocessing:')
 
@@ -164,173 +571,302 @@ def open_and_process(data_path, k, tol, max_iter, init, n_init, var_name, tau_va
         # Use premade clusters to calculate cluster labels (using specified distance metric) if they have been provided
         if isinstance(premade_cloud_regimes, str):
             lgr.info(' Calculating cluster_labels for premade_cloud_regimes:')
-            s = perf_counter()
-            try: cl = np.load(premade_cloud_regimes)
-            except: cl = xr.open_datarray(premade_cloud_regimes).values
+            cl = load_premade_cloud_regimes(premade_cloud_regimes, ds, tau_var_name, ht_var_name) / scale_factor
             k = len(cl)
-            if cl.shape != (k,len(ds[tau_var_name]) * len(ds[ht_var_name])):
-                raise Exception (f"""premade_cloud_regimes is the wrong shape. premade_cloud_regimes.shape = {cl.shape}, but must be shape {(k,len(ds.tau_var_name) * len(ds.ht_var_name))} 
-                to fit the loaded data. This shape mismatch often happens when fitting model data into CRs made from observation. Many of the satellite simulators include extra tau or cloud top pressure/height 
-                bins that do not exist in the observation data: you may need to sum these extra bins together to remove them. Additionally, some observation datasets
-                have additional tau or height/pressure bins (often labeled with values of -1) to indicate failed retrievals. It is important to trim off these extra bins before creating CRs
-                or fitting into CRs made by other data.""")
-            cluster_labels_temp = precomputed_clusters(mat, cl, wasserstein_or_euclidean, ds, tau_var_name, ht_var_name)
-            lgr.info(f' {round(perf_counter()-s)} seconds to calculate cluster_labels for premade_cloud_regimes:')
+            cluster_labels_temp = precomputed_clusters(mat, cl, wasserstein_or_euclidean, ds, tau_var_name, ht_var_name, emd_backend, config)
             
         # Otherwise preform clustering with specified distance metric
         else:
             lgr.info(' Beginning clustering:')
-            s = perf_counter()
-            if wasserstein_or_euclidean == "wasserstein":
-                cl, cluster_labels_temp, il, cl_list = emd_means(mat, k, tol, init, n_init, ds, tau_var_name, ht_var_name, max_iter, weights = None)
+            if wasserstein_or_euclidean == "wasserstein" and batch_size != None:
+                cl, cluster_labels_temp, il, cl_list = mini_batch_emd_means(mat, k, tol, init, n_init, ds, tau_var_name, ht_var_name, weights = None, batch_size = batch_size, emd_backend = emd_backend, config = config)
+            elif wasserstein_or_euclidean == "wasserstein":
+                cl, cluster_labels_temp, il, cl_list = emd_means(mat, k, tol, init, n_init, ds, tau_var_name, ht_var_name, max_iter, weights = None, emd_backend = emd_backend, config = config, checkpoint_path = checkpoint_path, resume_from = checkpoint_path if resume else None)
             elif wasserstein_or_euclidean == "euclidean":
-                cl, cluster_labels_temp = euclidean_kmeans(k, init, n_init, mat, max_iter, tol, gpu)
+                cl, cluster_labels_temp = euclidean_kmeans(k, init, n_init, mat, max_iter, tol, gpu, config)
             else: raise Exception ('Invalid option for wasserstein_or_euclidean. Please enter "wasserstein", "euclidean", or a numpy ndarray to use as premade cloud regimes and preform no clustering')
-            lgr.info(f' {round(perf_counter()-s)} seconds to cluster:')
 
         # Taking the flattened cluster_labels_temp array, and turning it into a datarray the shape of ds.var_name, and reinserting NaNs in place of missing data
-        cluster_labels = np.full(len(indicies), np.nan, dtype=np.int32)
+        cluster_labels = np.full(histograms.sizes['spacetime'], np.nan, dtype=np.int32)
         cluster_labels[valid_indicies]=cluster_labels_temp
         cluster_labels = xr.DataArray(data=cluster_labels, coords={"spacetime":histograms.spacetime},dims=("spacetime") )
         cluster_labels = cluster_labels.unstack()
         return mat, cluster_labels, cluster_labels_temp, valid_indicies, ds
 
+# Load premade cloud regimes from a .npy or netcdf file, and check that they fit the histograms in ds
+def load_premade_cloud_regimes(premade_cloud_regimes, ds, tau_var_name, ht_var_name):
+    try: cl = np.load(premade_cloud_regimes)
+    except: cl = xr.open_dataarray(premade_cloud_regimes).values
+    k = len(cl)
+    if cl.shape != (k,len(ds[tau_var_name]) * len(ds[ht_var_name])):
+        raise Exception (f"""premade_cloud_regimes is the wrong shape. premade_cloud_regimes.shape = {cl.shape}, but must be shape {(k,len(ds[tau_var_name]) * len(ds[ht_var_name]))} 
+        to fit the loaded data. This shape mismatch often happens when fitting model data into CRs made from observation. Many of the satellite simulators include extra tau or cloud top pressure/height 
+        bins that do not exist in the observation data: you may need to sum these extra bins together to remove them. Additionally, some observation datasets
+        have additional tau or height/pressure bins (often labeled with values of -1) to indicate failed retrievals. It is important to trim off these extra bins before creating CRs
+        or fitting into CRs made by other data.""")
+    return cl
+
+# Walk a preprocessed DataArray in blocks along its first (slowest varying) stacked dimension, yielding the valid histograms of each block
+def iter_histogram_blocks(ds, var_name, tau_var_name, ht_var_name, lat_var_name, chunk_size=None):
+    dims = list(ds.dims)
+    dims.remove(tau_var_name)
+    dims.remove(ht_var_name)
+    block_dim = dims[0]
+
+    # Number of histograms in a single step along block_dim, used to convert indicies within a block to indicies into the full stacked array
+    block_stride = int(np.prod([ds.sizes[dim] for dim in dims[1:]]))
+
+    # Using the dask chunks (one per file with open_mfdataset) as blocks unless a chunk_size has been specified
+    if chunk_size is None and ds.chunks is not None:
+        block_sizes = ds.chunksizes[block_dim]
+    else:
+        if chunk_size is None: chunk_size = ds.sizes[block_dim]
+        block_sizes = [chunk_size] * (ds.sizes[block_dim] // chunk_size)
+        if ds.sizes[block_dim] % chunk_size: block_sizes.append(ds.sizes[block_dim] % chunk_size)
+
+    start = 0
+    for size in block_sizes:
+        stop = start + size
+        histograms = ds.isel({block_dim:slice(start, stop)}).stack(spacetime=(dims), tau_ht=(tau_var_name, ht_var_name))
+        weights = np.cos(np.deg2rad(histograms[lat_var_name].values))
+        mat, valid_indicies, weights = filter_valid_histograms(histograms.values, weights, var_name)
+        yield start, stop, mat, valid_indicies + start * block_stride, weights
+        start = stop
+
+# Open and preprocess data the same way as open_and_process, but yield it in (mat_chunk, valid_indicies_chunk, weights_chunk) batches so the full histogram matrix is never held in memory
+# valid_indicies_chunk indexes into the full stacked spacetime dimension, exactly like valid_indicies returned by open_and_process
+def open_and_process_chunked(data_path, var_name, tau_var_name, ht_var_name, lat_var_name, lon_var_name, height_or_pressure, lat_range=None, lon_range=None, time_range=None, only_ocean_or_land=False, land_frac_var_name=None, chunk_size=None, parallel=True, index_path=None):
+    ds = open_and_preprocess(data_path, var_name, tau_var_name, ht_var_name, lat_var_name, lon_var_name, height_or_pressure, lat_range, lon_range, time_range, only_ocean_or_land, land_frac_var_name, parallel=parallel, index_path=index_path)
+
+    lgr.info(' Streaming data in blocks of shape (n_histograms, n_tau_bins* n_pc_bins):')
+    for start, stop, mat, valid_indicies, weights in iter_histogram_blocks(ds, var_name, tau_var_name, ht_var_name, lat_var_name, chunk_size):
+        yield mat, valid_indicies, weights
+
+# Fit data into premade cloud regimes one block of time steps at a time, writing the (time, lat, lon) cluster labels to the netcdf file output_path as they are calculated,
+# so only one block of histograms is ever held in memory. Missing data is labeled -1, the _FillValue of the labels.
+# If the run is interrupted, calling it again with the same arguments picks up after the last block that was written. Returns the labels as a lazy integer DataArray,
+# opened without masking so missing data stays -1 instead of becoming nan
+# prefilter and exact are passed to precomputed_clusters
+@span('assign_premade_cloud_regimes')
+def assign_premade_cloud_regimes(data_path, premade_cloud_regimes, output_path, var_name, tau_var_name, ht_var_name, lat_var_name, lon_var_name, height_or_pressure, wasserstein_or_euclidean = "euclidean",
+                                 lat_range=None, lon_range=None, time_range=None, only_ocean_or_land=False, land_frac_var_name=None, chunk_size=None, emd_backend="wasserstein", config=None, parallel=True, index_path=None, prefilter=False, exact=True):
+    ds = open_and_preprocess(data_path, var_name, tau_var_name, ht_var_name, lat_var_name, lon_var_name, height_or_pressure, lat_range, lon_range, time_range, only_ocean_or_land, land_frac_var_name, parallel=parallel, index_path=index_path)
+    cl = load_premade_cloud_regimes(premade_cloud_regimes, ds, tau_var_name, ht_var_name)
+    dims = list(ds.dims)
+    dims.remove(tau_var_name)
+    dims.remove(ht_var_name)
+    block_dim = dims[0]
+    block_coords = ds[block_dim].values
+    if np.issubdtype(block_coords.dtype, np.datetime64): block_coords = (block_coords - np.datetime64('1970-01-01')) / np.timedelta64(1, 's')
+    attributes = {'data_path':data_path, 'premade_cloud_regimes':os.path.abspath(premade_cloud_regimes), 'wasserstein_or_euclidean':wasserstein_or_euclidean, 'n_written':0}
+
+    # Creating the output file, or checking that an existing one was started by a call with the same data and cloud regimes
+    if os.path.isfile(output_path):
+        out = netCDF4.Dataset(output_path, 'a')
+        n_written = int(out.n_written)
+        if (out.data_path != data_path or out.premade_cloud_regimes != attributes['premade_cloud_regimes'] or out.wasserstein_or_euclidean != wasserstein_or_euclidean
+            or not np.array_equal(out[block_dim][:n_written], block_coords[:n_written])):
+            out.close()
+            raise Exception (f'{output_path} already exists and was made from different data or cloud regimes. Delete it or choose another output_path')
+        lgr.info(f' Resuming after {n_written} of {len(block_coords)} {block_dim} steps:')
+    else:
+        out = netCDF4.Dataset(output_path, 'w')
+        out.setncatts(attributes)
+        for dim in dims:
+            out.createDimension(dim, None if dim == block_dim else ds.sizes[dim])
+            coord = out.createVariable(dim, 'f8', (dim,))
+            if dim != block_dim: coord[:] = ds[dim].values
+        if np.issubdtype(ds[block_dim].dtype, np.datetime64): out[block_dim].units = 'seconds since 1970-01-01'
+        labels = out.createVariable('cluster_labels', 'i4', dims, fill_value=-1, chunksizes=[1] + [ds.sizes[dim] for dim in dims[1:]])
+        labels.k = len(cl)
+        n_written = 0
+
+    # Assigning and writing the labels of each remaining block, recording how many steps along block_dim have been written once they are safely on disk
+    try:
+        block_shape = [ds.sizes[dim] for dim in dims[1:]]
+        for start, stop, mat, valid_indicies, weights in iter_histogram_blocks(ds.isel({block_dim:slice(n_written, None)}), var_name, tau_var_name, ht_var_name, lat_var_name, chunk_size):
+            with span('assign_block', count=len(mat), message=f'assign and write {block_dim} steps {start + n_written} to {stop + n_written} of {len(block_coords)}'):
+                labels = np.full((stop - start) * int(np.prod(block_shape)), -1, dtype=np.int32)
+                if len(mat) > 0: labels[valid_indicies - start * int(np.prod(block_shape))] = precomputed_clusters(mat, cl, wasserstein_or_euclidean, ds, tau_var_name, ht_var_name, emd_backend, config, prefilter, exact)
+                start, stop = start + n_written, stop + n_written
+                out[block_dim][start:stop] = block_coords[start:stop]
+                out['cluster_labels'][start:stop] = labels.reshape([stop - start] + block_shape)
+                out.sync()
+                out.n_written = stop
+                out.sync()
+    finally:
+        out.close()
+
+    return xr.open_dataset(output_path, mask_and_scale=False)['cluster_labels']
+
+# Area weighted statistics of k cloud regimes, computed with one grouped reduction over the labels instead of one pass per regime. Returns an xr.Dataset of:
+# rfo, the area weighted relative frequency of occurence of each CR in percent, rfo_map, the relative frequency of occurence of each CR at each grid cell
+# (taken over the first dimension of cluster_labels, usually time), and if mat and cluster_labels_temp are given, mean_histogram, the area weighted mean histogram of each CR
+@span('cloud_regime_statistics')
+def cloud_regime_statistics(cluster_labels, k, ds=None, tau_var_name=None, ht_var_name=None, valid_indicies=None, mat=None, cluster_labels_temp=None, lat_var_name='lat'):
+    map_dims = cluster_labels.dims[1:]
+    labels = cluster_labels.values.reshape(cluster_labels.shape[0], -1)
+    n_cells = labels.shape[1]
+
+    # Number of times each CR occurs at each grid cell, from one bincount over (grid cell, CR) pairs
+    valid = (labels >= 0) & (labels < k)
+    cells = np.broadcast_to(np.arange(n_cells), labels.shape)[valid]
+    counts = np.bincount(cells * k + labels[valid].astype(np.int64), minlength=n_cells * k).reshape(n_cells, k)
+
+    # The area weight cos(lat) is the same for every occurence at a grid cell
+    cell_weights = np.cos(np.deg2rad(cluster_labels[lat_var_name])).broadcast_like(cluster_labels.isel({cluster_labels.dims[0]:0}, drop=True)).transpose(*map_dims).values.ravel()
+    weighted_counts = cell_weights @ counts
+    n_valid = counts.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rfo_map = (counts / n_valid[:,None] * 100).T.reshape(k, *cluster_labels.shape[1:])
+
+    coords = {dim:cluster_labels[dim] for dim in map_dims if dim in cluster_labels.coords}
+    stats = xr.Dataset({'rfo':(('cluster',), weighted_counts / np.sum(weighted_counts) * 100),
+                        'rfo_map':(('cluster', *map_dims), rfo_map)}, coords={'cluster':np.arange(k), **coords})
+
+    # Area weighted mean histogram of each CR, unpacking quantized histograms
+    if mat is not None:
+        weights = np.cos(np.deg2rad(cluster_labels[lat_var_name])).broadcast_like(cluster_labels).transpose(*cluster_labels.dims).values.ravel()[valid_indicies]
+        means = cluster_means(mat, cluster_labels_temp, k, weights) * ds.attrs.get('mat_scale_factor', 1)
+        stats['mean_histogram'] = xr.DataArray(means.reshape(k, len(ds[tau_var_name]), len(ds[ht_var_name])), dims=('cluster', tau_var_name, ht_var_name),
+                                               coords={tau_var_name:ds[tau_var_name].values, ht_var_name:ds[ht_var_name].values})
+
+    return stats
+
+# Figure templates kept by draw_cluster_centers, draw_rfo_maps and draw_correlation_matrix when they are called with reuse_figure = True, keyed by the layout of the figure.
+# The axes, coastlines, ticks and colorbar of a layout are only drawn once, and only the plotted data and titles are replaced for each new figure
+figure_templates = {}
+
+# Make a new figure. Figures that will not be shown are made on an Agg canvas without pyplot, so they never touch an interactive backend or the pyplot state
+def new_figure(show, **kwargs):
+    if show: return plt.figure(**kwargs)
+    fig = Figure(**kwargs)
+    FigureCanvasAgg(fig)
+    return fig
+
+# Save fig to save_file if one is given, and show and close it if show is True
+def finish_figure(fig, save_file=None, show=True):
+    if save_file != None: fig.savefig(save_file)
+    if show:
+        plt.show()
+        plt.close(fig)
+
+# Colors and bounds of the cloud cover colormap used to plot histograms
+histogram_cmap_bounds = [0,0.2,1,2,3,4,6,8,10,15,99]
+histogram_cmap = mpl.colors.ListedColormap(['white', (0.19215686274509805, 0.25098039215686274, 0.5607843137254902), (0.23529411764705882, 0.3333333333333333, 0.6313725490196078), (0.32941176470588235, 0.5098039215686274, 0.6980392156862745), (0.39215686274509803, 0.6, 0.43137254901960786), (0.44313725490196076, 0.6588235294117647, 0.21568627450980393), (0.4980392156862745, 0.6784313725490196, 0.1843137254901961), (0.5725490196078431, 0.7137254901960784, 0.16862745098039217), (0.7529411764705882, 0.8117647058823529, 0.2), (0.9568627450980393, 0.8980392156862745,0.1607843137254902)])
+
 # Plot the CR cluster centers
-def plot_hists(cluster_labels, k, ds, ht_var_name, tau_var_name, valid_indicies, mat, cluster_labels_temp, height_or_pressure, save_path):
+# stats can be the output of cloud_regime_statistics, to share it with plot_rfo instead of computing it again
+# With show = False the figure is only saved, see draw_cluster_centers
+def plot_hists(cluster_labels, k, ds, ht_var_name, tau_var_name, valid_indicies, mat, cluster_labels_temp, height_or_pressure, save_path, stats=None, show=True):
+    if stats is None or 'mean_histogram' not in stats: stats = cloud_regime_statistics(cluster_labels, k, ds, tau_var_name, ht_var_name, valid_indicies, mat, cluster_labels_temp)
+    draw_cluster_centers(stats, k, tau_var_name, ht_var_name, height_or_pressure, save_path, show)
 
+    #TODO why is this here?
+    return mat, cluster_labels, cluster_labels_temp, valid_indicies, ds
+
+# Empty figure of k cluster center panels, returning the figure, its axes and the mesh of each panel
+def cluster_centers_template(k, n_tau, n_ht, height_or_pressure, show):
     # setting up plots
-    ylabels = ds[ht_var_name].values
-    xlabels = ds[tau_var_name].values
-    X2,Y2 = np.meshgrid(np.arange(len(xlabels)+1), np.arange(len(ylabels)+1))
-    p = [0,0.2,1,2,3,4,6,8,10,15,99]
-    cmap = mpl.colors.ListedColormap(['white', (0.19215686274509805, 0.25098039215686274, 0.5607843137254902), (0.23529411764705882, 0.3333333333333333, 0.6313725490196078), (0.32941176470588235, 0.5098039215686274, 0.6980392156862745), (0.39215686274509803, 0.6, 0.43137254901960786), (0.44313725490196076, 0.6588235294117647, 0.21568627450980393), (0.4980392156862745, 0.6784313725490196, 0.1843137254901961), (0.5725490196078431, 0.7137254901960784, 0.16862745098039217), (0.7529411764705882, 0.8117647058823529, 0.2), (0.9568627450980393, 0.8980392156862745,0.1607843137254902)])
-    norm = mpl.colors.BoundaryNorm(p,cmap.N)
-    plt.rcParams.update({'font.size': 12})
+    X2,Y2 = np.meshgrid(np.arange(n_tau+1), np.arange(n_ht+1))
+    p = histogram_cmap_bounds
+    cmap = histogram_cmap
     fig_height = 1 + 10/3 * ceil(k/3)
-    fig, ax = plt.subplots(figsize = (17, fig_height), ncols=3, nrows=ceil(k/3), sharex='all', sharey = True)
+    fig = new_figure(show, figsize = (17, fig_height))
+    ax = fig.subplots(ncols=3, nrows=ceil(k/3), sharex='all', sharey = True)
 
     aa = ax.ravel()
     boundaries = p
     norm = mpl.colors.BoundaryNorm(boundaries, cmap.N, clip=True)
     aa[1].invert_yaxis()
 
-    # creating weights area for area weighted RFOs
-    weights = cluster_labels.stack(z=('time','lat','lon')).lat.values
-    weights = np.cos(np.deg2rad(weights))
-    weights = weights[valid_indicies]
-    indicies = np.arange(len(mat))
-
-    # Plotting each cluster center
-    for i in range (k):
-
-        # Area Weighted relative Frequency of occurence calculation
-        total_rfo_num = cluster_labels == i 
-        total_rfo_num = np.sum(total_rfo_num * np.cos(np.deg2rad(cluster_labels.lat)))
-        total_rfo_denom = cluster_labels >= 0
-        total_rfo_denom = np.sum(total_rfo_denom * np.cos(np.deg2rad(cluster_labels.lat)))
-        total_rfo = total_rfo_num  / total_rfo_denom * 100
-        total_rfo = total_rfo.values
-
-        # Area weighting each histogram belonging to a cluster and taking the mean
-        # if clustering was preformed with wasserstein distance and area weighting on, mean of i = cl[i], however if clustering was preformed with
-        # conventional kmeans or wasseerstein without weighting, these two will not be equal
-        indicies_i = indicies[np.where(cluster_labels_temp == i)]
-        mean = mat[indicies_i] * weights[indicies_i][:,np.newaxis]
-        mean = np.sum(mean, axis=0) / np.sum(weights[indicies_i])
-        mean = mean.reshape(len(xlabels),len(ylabels)).T           # reshaping into original histogram shape
-        if np.max(mean) <= 1:                                      # Converting fractional data to percent to plot properly
-            mean *= 100
-
-        im = aa[i].pcolormesh(X2,Y2,mean,norm=norm,cmap=cmap)
-        aa[i].set_title(f"CR {i+1}, RFO = {np.round(total_rfo,1)}%")
+    # A mesh for each cluster center, which is filled in by draw_cluster_centers
+    meshes = [aa[i].pcolormesh(X2,Y2,np.zeros((n_ht, n_tau)),norm=norm,cmap=cmap) for i in range(k)]
 
     # setting titles, labels, etc
     if height_or_pressure == 'p': fig.supylabel(f'Cloud-top Pressure', fontsize = 12, x = 0.09 )
     if height_or_pressure == 'h': fig.supylabel(f'Cloud-top Height', fontsize = 12, x = 0.09  )
     # fig.supxlabel('Optical Depth', fontsize = 12, y=0.26 )
     cbar_ax = fig.add_axes([0.95, 0.38, 0.045, 0.45])
-    cb = fig.colorbar(im, cax=cbar_ax, ticks=p)
+    cb = fig.colorbar(meshes[0], cax=cbar_ax, ticks=p)
     cb.set_label(label='Cloud Cover (%)', size =10)
     cb.ax.tick_params(labelsize=9)
-    #aa[6].set_position([0.399, 0.125, 0.228, 0.215])
-    #aa[6].set_position([0.33, 0.117, 0.36, 0.16])
-    #aa[-2].remove()
 
     bbox = aa[1].get_position()
     p1 = bbox.p1
-    p0 = bbox.p0
     fig.suptitle(f'Cloud Regimes', x=0.5, y=p1[1]+(1/fig_height * 0.5), fontsize=15)
 
     bbox = aa[-2].get_position()
-    p1 = bbox.p1
     p0 = bbox.p0
     fig.supxlabel('Optical Depth', fontsize = 12, y=p0[1]-(1/fig_height * 0.5) )
 
-
     # Removing extra plots
     for i in range(ceil(k/3)*3-k):
         aa[-(i+1)].remove()
 
-    if save_path != None:
-        plt.savefig(save_path + 'cluster_centers.png')
+    return fig, aa, meshes
 
-    plt.show()
-    plt.close()
+# Draw the mean histograms and RFOs of k CRs in stats, the output of cloud_regime_statistics, and save them to save_path + 'cluster_centers.png'
+# With show = False nothing is displayed and no rcParams or pyplot state is changed. With reuse_figure = True as well, the figure is kept as a template
+# for the next figure with the same layout
+@span('draw_cluster_centers')
+def draw_cluster_centers(stats, k, tau_var_name, ht_var_name, height_or_pressure, save_path, show=True, reuse_figure=False):
+    reuse_figure = reuse_figure and not show
+    with mpl.rc_context({'font.size': 12}):
+        key = ('cluster_centers', k, stats.sizes[tau_var_name], stats.sizes[ht_var_name], height_or_pressure)
+        if reuse_figure and key in figure_templates: fig, aa, meshes = figure_templates[key]
+        else: fig, aa, meshes = cluster_centers_template(k, stats.sizes[tau_var_name], stats.sizes[ht_var_name], height_or_pressure, show)
+        if reuse_figure: figure_templates[key] = fig, aa, meshes
 
-    #TODO why is this here?
-    return mat, cluster_labels, cluster_labels_temp, valid_indicies, ds
+        # Plotting each cluster center
+        for i in range (k):
+
+            # Area Weighted relative Frequency of occurence
+            total_rfo = stats.rfo.values[i]
+
+            # Area weighted mean of the histograms belonging to each cluster
+            # if clustering was preformed with wasserstein distance and area weighting on, mean of i = cl[i], however if clustering was preformed with
+            # conventional kmeans or wasseerstein without weighting, these two will not be equal
+            mean = stats.mean_histogram.values[i].T                  # transposing into original histogram shape
+            if np.max(mean) <= 1:                                      # Converting fractional data to percent to plot properly
+                mean = mean * 100
+
+            meshes[i].set_array(mean)
+            aa[i].set_title(f"CR {i+1}, RFO = {np.round(total_rfo,1)}%")
+
+        finish_figure(fig, save_path + 'cluster_centers.png' if save_path != None else None, show)
 
 # Plot RFO maps of the CRss
-def plot_rfo(cluster_labels, k ,ds, save_path):
-    
-    COLOR = 'black'
-    mpl.rcParams['text.color'] = COLOR
-    mpl.rcParams['axes.labelcolor'] = COLOR
-    mpl.rcParams['xtick.color'] = COLOR
-    mpl.rcParams['ytick.color'] = COLOR
-    plt.rcParams.update({'font.size': 10})
-    plt.rcParams['figure.dpi'] = 150
+# stats can be the output of cloud_regime_statistics, to share it with plot_hists instead of computing it again
+# With show = False the figure is only saved, see draw_rfo_maps
+def plot_rfo(cluster_labels, k ,ds, save_path, stats=None, show=True):
+    if stats is None: stats = cloud_regime_statistics(cluster_labels, k)
+    draw_rfo_maps(stats, k, save_path, show)
+
+# Empty figure of k RFO map panels on the lat/lon grid of stats, returning the figure, its axes and the mesh of each panel
+def rfo_maps_template(k, lats, lons, show):
     fig_height = 2.2 * ceil(k/2)
-    fig, ax = plt.subplots(ncols=2, nrows=int(k/2 + k%2), subplot_kw={'projection': ccrs.PlateCarree()}, figsize = (10,fig_height))#, sharex='col', sharey='row')
-    plt.subplots_adjust(wspace=0.13, hspace=0.05)
+    fig = new_figure(show, figsize = (10,fig_height))
+    ax = fig.subplots(ncols=2, nrows=int(k/2 + k%2), subplot_kw={'projection': ccrs.PlateCarree()})#, sharex='col', sharey='row')
+    fig.subplots_adjust(wspace=0.13, hspace=0.05)
     aa = ax.ravel()
 
-    X, Y = np. meshgrid(ds.lon,ds.lat)
+    X, Y = np. meshgrid(lons,lats)
 
-    # Plotting the rfo of each cluster
-    tot_rfo_sum = 0 
-    
+    # A mesh for each cluster, which is filled in by draw_rfo_maps
+    meshes = []
     for cluster in range(k): #range(0,k+1):
-        # Calculating rfo
-        rfo = np.sum(cluster_labels==cluster, axis=0) / np.sum(cluster_labels >= 0, axis=0) * 100
-        # tca_explained = np.sum(cluster_labels == cluster) * np.sum(init_clusters[cluster]) / total_cloud_amnt * 100
-        # tca_explained = round(float(tca_explained.values),1)
         aa[cluster].set_extent([-180, 180, -90, 90])
         aa[cluster].coastlines()
-        mesh = aa[cluster].pcolormesh(X, Y, rfo, transform=ccrs.PlateCarree(), rasterized = True, cmap="GnBu",vmin=0,vmax=100)
-        #total_rfo = np.sum(cluster_labels==cluster) / np.sum(cluster_labels >= 0) * 100
-        # total_rfo_num = np.sum(cluster_labels == cluster * np.cos(np.deg2rad(cluster_labels.lat)))
-        total_rfo_num = cluster_labels == cluster 
-        total_rfo_num = np.sum(total_rfo_num * np.cos(np.deg2rad(cluster_labels.lat)))
-        total_rfo_denom = cluster_labels >= 0
-        total_rfo_denom = np.sum(total_rfo_denom * np.cos(np.deg2rad(cluster_labels.lat)))
-
-        total_rfo = total_rfo_num  / total_rfo_denom * 100
-        tot_rfo_sum += total_rfo
-        aa[cluster].set_title(f"CR {cluster+1}, RFO = {round(float(total_rfo),1)}", pad=4)
+        meshes.append(aa[cluster].pcolormesh(X, Y, np.zeros(X.shape), transform=ccrs.PlateCarree(), rasterized = True, cmap="GnBu",vmin=0,vmax=100))
         # aa[cluster].gridlines(draw_labels=True, dms=True, x_inline=False, y_inline=False)
-        # x_label_plot_list = [4,5,6]
-        # y_label_plot_list = [0,2,4,6]
-        # if cluster in x_label_plot_list:
-
 
         if cluster % 2 == 0:
             aa[cluster].set_yticks([-60,-30,0,30,60], crs=ccrs.PlateCarree())        
             lat_formatter = LatitudeFormatter()
             aa[cluster].yaxis.set_major_formatter(lat_formatter)
 
-    #aa[7].set_title(f"Weathersdfasdfa State {i+1}, RFO = {round(float(total_rfo),1)}", pad=-40)
-    cb = plt.colorbar(mesh, ax = ax, anchor =(-0.28,0.83), shrink = 0.6)
+    cb = fig.colorbar(meshes[-1], ax = ax, anchor =(-0.28,0.83), shrink = 0.6)
     cb.set_label(label = 'RFO (%)', labelpad=-3)
 
     x_ticks_indicies = np.array([-1,-2])
@@ -339,8 +875,6 @@ def plot_rfo(cluster_labels, k ,ds, save_path):
         aa[-1].remove()
         x_ticks_indicies -= 1
 
-        #aa[-2].set_position([0.27, 0.11, 0.31, 0.15])
-
     # plotting x labels on final two plots
     aa[x_ticks_indicies[0]].set_xticks([-120,-60,0,60,120,], crs=ccrs.PlateCarree())
     lon_formatter = LongitudeFormatter(zero_direction_label=True)
@@ -351,42 +885,430 @@ def plot_rfo(cluster_labels, k ,ds, save_path):
 
     bbox = aa[1].get_position()
     p1 = bbox.p1
-    plt.suptitle(f"CR Relative Frequency of Occurence", x= 0.43, y= p1[1]+(1/fig_height * 0.5))#, {round(cl[cluster,23],4)}")
-    
-    if save_path != None:
-        plt.savefig(save_path + 'rfo_maps.png')
+    fig.suptitle(f"CR Relative Frequency of Occurence", x= 0.43, y= p1[1]+(1/fig_height * 0.5))
 
-    plt.show()
-    plt.close()
+    return fig, aa, meshes
 
+# Draw the RFO maps and RFOs of k CRs in stats, the output of cloud_regime_statistics, and save them to save_path + 'rfo_maps.png'
+# With show = False nothing is displayed and no rcParams or pyplot state is changed. With reuse_figure = True as well, the figure (with its coastlines and ticks)
+# is kept as a template for the next figure on the same grid
+@span('draw_rfo_maps')
+def draw_rfo_maps(stats, k, save_path, show=True, reuse_figure=False):
+    reuse_figure = reuse_figure and not show
+    COLOR = 'black'
+    with mpl.rc_context({'text.color':COLOR, 'axes.labelcolor':COLOR, 'xtick.color':COLOR, 'ytick.color':COLOR, 'font.size':10, 'figure.dpi':150}):
+        key = ('rfo_maps', k, stats.lat.values.tobytes(), stats.lon.values.tobytes())
+        if reuse_figure and key in figure_templates: fig, aa, meshes = figure_templates[key]
+        else: fig, aa, meshes = rfo_maps_template(k, stats.lat.values, stats.lon.values, show)
+        if reuse_figure: figure_templates[key] = fig, aa, meshes
+
+        # Plotting the rfo of each cluster
+        for cluster in range(k):
+            meshes[cluster].set_array(np.ma.masked_invalid(stats.rfo_map.values[cluster]))
+            total_rfo = stats.rfo.values[cluster]
+            aa[cluster].set_title(f"CR {cluster+1}, RFO = {round(float(total_rfo),1)}", pad=4)
+
+        finish_figure(fig, save_path + 'rfo_maps.png' if save_path != None else None, show)
+
+# Render figures in n_jobs worker processes without displaying any of them, for example every figure of a k sweep. tasks is a list of (function, kwargs) pairs,
+# where function is a drawing function (draw_cluster_centers, draw_rfo_maps, draw_correlation_matrix or plot_hists_k_testing) and kwargs are its arguments,
+# for example (draw_rfo_maps, {'stats':stats, 'k':k, 'save_path':save_path}). Consecutive tasks are run by the same worker, so figures with the same layout
+# reuse one figure template. n_jobs = 1 renders the figures in this process
+def render_figures(tasks, n_jobs=None):
+    if n_jobs is None: n_jobs = default_num_threads()
+    n_jobs = max(1, min(n_jobs, len(tasks)))
+    if n_jobs == 1:
+        for task in tasks: _render_task(task)
+        return
+    with ProcessPoolExecutor(n_jobs, mp_context=get_context('spawn'), initializer=mpl.use, initargs=('Agg',)) as executor:
+        list(executor.map(_render_task, tasks, chunksize=ceil(len(tasks) / n_jobs)))
+
+# Run one render_figures task headlessly, reusing figure templates where the drawing function supports them
+def _render_task(task):
+    function, kwargs = task
+    kwargs = {**kwargs, 'show':False}
+    if 'reuse_figure' in inspect.signature(function).parameters: kwargs['reuse_figure'] = True
+    function(**kwargs)
+
+# Create the flattened position matrix of the tau and height/pressure bins, and the R hyperparameter, needed for EMD calculations on an (n1, n2) histogram grid
+def emd_grid(n1, n2):
+    # Calculating the max distance between two points to be used as hyperparameter in EMD
+    # This is not necesarily the only value for this variable that can be used, see Wasserstein documentation
+    # on R hyper-parameter for more information
+    R = (n1**2+n2**2)**0.5
 
-# K-means algorithm that uses wasserstein distance
-def emd_means(mat, k, tol, init, n_init, ds, tau_var_name, ht_var_name, hard_stop = 45, weights = None):
+    # Creating a flattened position matrix to pass wasersstein.PairwiseEMD
+    position_matrix = np.zeros((2,n1,n2))
+    position_matrix[0] = np.tile(np.arange(n2),(n1,1))
+    position_matrix[1] = np.tile(np.arange(n1),(n2,1)).T
+    position_matrix = position_matrix.reshape(2,-1)
 
-    # A function to convert mat into the form reqired by the wasserstein package
-    @njit()
-    def stacking(position_matrix, centroids):
-        centroid_list = []
+    return position_matrix, R
+
+# Ground cost matrix between every pair of bins of the histogram grid, scaled by R the same way as the wasserstein package
+def ground_cost_matrix(position_matrix, R):
+    diff = position_matrix[:, :, None] - position_matrix[:, None, :]
+    return np.sqrt(np.sum(diff**2, axis=0)) / R
+
+# Entropic (Sinkhorn) approximation of the EMD between every histogram in a and every histogram in b, specialized for histograms that all live on the same grid
+# Histograms are normalized like wasserstein.PairwiseEMD(norm=True). Smaller reg (relative to the largest ground cost) is closer to the exact EMD, but needs more iterations
+# The (n_a * n_b, n_bins) scaling vectors are updated for a whole block of rows of a at once with a single matrix multiplication, with at most block_size elements per block
+def sinkhorn_emd(a, b, cost, reg=0.02, n_iter=100, tol=1e-6, block_size=2**20, dtype=np.float32):
+    n, d = a.shape
+    k = len(b)
+    K = np.exp(-cost / (reg * np.max(cost))).astype(dtype)
+    KC = (K * cost).astype(dtype)
+
+    # Normalizing histograms, empty histograms are dealt with at the end
+    a_sum = np.sum(a, axis=1)
+    b_sum = np.sum(b, axis=1)
+    a = (a / np.where(a_sum > 0, a_sum, 1)[:, None]).astype(dtype)
+    b = (b / np.where(b_sum > 0, b_sum, 1)[:, None]).astype(dtype)
+    tiny = np.finfo(dtype).tiny
+
+    distances = np.empty((n, k))
+    rows = max(1, block_size // (k * d))
+    for start in range(0, n, rows):
+        a_block = a[start:start + rows, None, :]  # (m, 1, d)
+        m = len(a_block)
+        v = np.ones((m * k, d), dtype=dtype)
+        for i in range(n_iter):
+            u = (a_block / np.maximum(v @ K, tiny).reshape(m, k, d)).reshape(m * k, d)
+            v = (b[None] / np.maximum(u @ K, tiny).reshape(m, k, d)).reshape(m * k, d)
+
+            # Checking every 10 iterations if the transport plans match the marginals of a closely enough to stop
+            if i % 10 == 9 and np.max(np.sum(np.abs((u * (v @ K)).reshape(m, k, d) - a_block), axis=2)) < tol: break
+
+        distances[start:start + rows] = np.sum(u * (v @ KC), axis=1).reshape(m, k)
+
+    # There is no mass to move for empty histograms, so they are a distance of 1 (the cost of creating all of the mass) from every non empty histogram
+    distances[a_sum == 0] = 1
+    distances[:, b_sum == 0] = 1
+    distances[np.ix_(a_sum == 0, b_sum == 0)] = 0
+
+    return distances
+
+# Create a function that returns the (len(a), len(b)) matrix of EMDs between every histogram in a and every histogram in b on an (n1, n2) histogram grid
+# emd_backend = "wasserstein" uses the exact solver from the wasserstein package, emd_backend = "sinkhorn" uses the in-project entropic solver, which does not need the wasserstein package
+# A function previously made by emd_distance_function (for example with a different sinkhorn_reg) can also be passed as emd_backend, and is returned unchanged
+# The number of threads and floating point type are taken from config, a RuntimeConfig
+def emd_distance_function(n1, n2, emd_backend="wasserstein", verbose=0, sinkhorn_reg=0.02, sinkhorn_iter=100, config=None):
+    if callable(emd_backend): return emd_backend
+    if config is None: config = RuntimeConfig()
+    dtype = config.dtype
+
+    position_matrix, R = emd_grid(n1, n2)
+
+    if emd_backend == "wasserstein":
+        # Initialising wasserstein.PairwiseEMD
+        emds = wasserstein.PairwiseEMD(R = R, norm=True, dtype=dtype, verbose=verbose, num_threads=config.num_threads)
+
+        # A single (n_bins, 2) array of bin positions shared by every histogram, instead of a (n_bins, 3) array of weights and positions for each histogram
+        positions = np.ascontiguousarray(position_matrix.T, dtype=dtype)
+
+        # The same histograms are usually passed in every iteration, so the last two copies made of inputs that were not already dtype are kept
+        # Quantized histograms are converted a block at a time instead, so a full floating point copy of them is never made
+        converted = []
+        def as_dtype(a):
+            if a.dtype == dtype and a.flags.c_contiguous: return a
+            for array, array_converted in converted:
+                if array is a: return array_converted
+            converted.insert(0, (a, np.ascontiguousarray(a, dtype=dtype)))
+            del converted[2:]
+            return converted[0][1]
+
+        # Adding events one at a time uses internals of wasserstein 1.1 (see environment.yml), so other versions that do not have them fall back to the public interface
+        add_events = hasattr(emds, '_add_event')
+        if not add_events: lgr.warning(f' wasserstein {getattr(wasserstein, "__version__", "")} does not have PairwiseEMD._add_event, EMDs will be computed with per histogram copies')
+
+        def emd(a, b, block_size=2**18):
+            if np.issubdtype(a.dtype, np.integer) and len(a) > block_size:
+                return np.concatenate([emd(a[start:start + block_size], b) for start in range(0, len(a), block_size)])
+            a, b = as_dtype(a), as_dtype(b)
+            if not add_events:
+                # (n_histograms, n_bins, 3) arrays of the weight and position of every bin, the events wasserstein.PairwiseEMD.__call__ expects
+                events = [np.concatenate([x[:, :, None], np.broadcast_to(positions, (len(x),) + positions.shape)], axis=2) for x in (a, b)]
+                emds(events[0], events[1])
+                return emds.emds()
+            # Adding each histogram as a row view of a or b that points to the shared positions, so no memory is allocated per histogram
+            # This does what wasserstein.PairwiseEMD.__call__ does, minus the per histogram copies. The arrays must stay alive until the EMDs are computed
+            emds.init(len(a), len(b))
+            emds.event_arrs = (a, b, positions)
+            for row in a: emds._add_event(row, positions, 1.0)
+            for row in b: emds._add_event(row, positions, 1.0)
+            emds.compute()
+            return emds.emds()
+
+    elif emd_backend == "sinkhorn":
+        cost = ground_cost_matrix(position_matrix, R)
+        def emd(a, b):
+            with threadpool_limits(limits=config.num_threads):
+                return sinkhorn_emd(a, b, cost, sinkhorn_reg, sinkhorn_iter, dtype=dtype)
+
+    else: raise Exception (f'Invalid option for emd_backend. Please enter "wasserstein" or "sinkhorn". You entered {emd_backend}')
+
+    return emd
+
+# Cheap lower bounds on the EMD between every histogram in a and every histogram in b on an (n1, n2) histogram grid, in the same units as emd_distance_function
+# Projecting both histograms onto the tau axis, the height/pressure axis, or the line between their centers of mass can only shorten the distance mass is moved,
+# so the 1-D EMDs between their marginals and the distance between their centers of mass are all lower bounds on the EMD. Empty histograms get a bound of 0
+def emd_lower_bounds(a, b, n1, n2, block_size=2**24):
+    position_matrix, R = emd_grid(n1, n2)
+
+    # Normalized (n, n1) and (n, n2) marginals of each histogram, as cumulative distributions, and the centers of mass
+    def marginals(x):
+        total = np.sum(x, axis=1)
+        x = x.reshape(len(x), n1, n2) / np.where(total > 0, total, 1)[:, None, None]
+        cdf1 = np.cumsum(np.sum(x, axis=2), axis=1)
+        cdf2 = np.cumsum(np.sum(x, axis=1), axis=1)
+        center = x.reshape(len(x), -1) @ position_matrix.T
+        return cdf1, cdf2, center, total > 0
+    b_cdf1, b_cdf2, b_center, b_full = marginals(np.asarray(b, dtype=np.float64))
+
+    lower = np.zeros((len(a), len(b)))
+    rows = max(1, block_size // (len(b) * max(n1, n2)))
+    for start in range(0, len(a), rows):
+        a_cdf1, a_cdf2, a_center, a_full = marginals(np.asarray(a[start:start + rows], dtype=np.float64))
+        w1 = np.sum(np.abs(a_cdf1[:, None, :] - b_cdf1[None]), axis=2)
+        w2 = np.sum(np.abs(a_cdf2[:, None, :] - b_cdf2[None]), axis=2)
+        centers = np.sqrt(np.sum((a_center[:, None, :] - b_center[None])**2, axis=2))
+        lower[start:start + rows] = np.maximum(np.maximum(w1, w2), centers) / R * (a_full[:, None] & b_full[None])
+
+    return lower
+
+# Assign each histogram in mat to its closest centroid in cl, only computing the exact EMDs that emd_lower_bounds can not rule out. emd is a function made by emd_distance_function
+# The centroid with the smallest lower bound is computed first, and gives an upper bound on the distance to the closest centroid. Only centroids with a lower bound below that
+# (plus slack, for the rounding of emd) can still be closer. With exact = True the labels are the same as computing every EMD, with exact = False at most max_candidates
+# centroids per histogram get exact EMDs, which is faster but can mislabel histograms whose best centroids have loose bounds
+# Returns the labels, the EMD between each histogram and its assigned centroid, and the number of EMDs that were computed
+def emd_prefiltered_assignment(mat, cl, emd, n1, n2, exact=True, max_candidates=2, slack=1e-5):
+    n, k = len(mat), len(cl)
+    lower = emd_lower_bounds(mat, cl, n1, n2)
+    rank = np.argsort(np.argsort(lower, axis=1, kind='stable'), axis=1)
+
+    distances = np.full((n, k), np.inf)
+    first = np.argmin(lower, axis=1)
+    for i in range(k):
+        rows = np.flatnonzero(first == i)
+        if len(rows): distances[rows, i] = emd(mat[rows], cl[i:i+1])[:,0]
+    upper = distances[np.arange(n), first]
 
-        for i in range(len(centroids)):
-            x = np.empty((3,len(mat[0]))).T
-            x[:,0] = centroids[i]
-            x[:,1] = position_matrix[0]
-            x[:,2] = position_matrix[1]
-            centroid_list.append(x)
+    candidates = lower <= upper[:,None] + slack
+    candidates[np.arange(n), first] = False
+    if not exact: candidates &= rank < max_candidates
+    for i in range(k):
+        rows = np.flatnonzero(candidates[:,i])
+        if len(rows): distances[rows, i] = emd(mat[rows], cl[i:i+1])[:,0]
 
-        return centroid_list
+    labels = np.argmin(distances, axis=1)
+    return labels, distances[np.arange(n), labels], n + int(np.sum(candidates))
+
+# Pick k initial centroids from mat for emd_means, with kmeans++, kmeans|| or at random. emd is a function made by emd_distance_function, and rng a numpy random Generator
+# A running minimum of the EMD from each histogram to the centroids picked so far is kept, so each kmeans++ step computes a single column of EMDs
+# n_candidates > 1 uses greedy kmeans++: n_candidates histograms are drawn each step, and the one that lowers the total distance to the closest centroid the most is kept
+# "k-means||" draws about oversampling (2k by default) candidates per round for n_rounds rounds, each round needing a single batch of EMDs that can be spread over all threads,
+# and then picks k of them with kmeans++ weighted by how many histograms each is closest to. With subsample set, centroids are only picked from that many random histograms
+def emd_init_centroids(mat, k, init, emd, rng, n_candidates=1, subsample=None, oversampling=None, n_rounds=5):
+    if subsample != None and subsample < len(mat):
+        mat = mat[np.sort(rng.choice(len(mat), subsample, replace=False))]
+    n = len(mat)
+
+    # Probabilities proportional to distance to the closest centroid, falling back to uniform if every histogram is already a centroid
+    def probabilities(distances):
+        total = np.sum(distances)
+        return distances / total if total > 0 else np.full(len(distances), 1 / len(distances))
+
+    # Using Kmeans++ if init  == True
+    if init == 'k-means++':
+        with span('seed_centroids', count=n, message='k-means++ initialization'):
+            init_clusters = np.zeros((k, len(mat[0])))
+            init_clusters[0] = mat[rng.integers(0,len(mat))]
+
+            min_dists = emd(mat, init_clusters[0:1])[:,0]
+            for i in range(1, k):
+                choice = rng.choice(n, n_candidates, p=probabilities(min_dists))
+
+                if n_candidates == 1:
+                    init_clusters[i] = mat[choice[0]]
+                    if i < k - 1: min_dists = np.minimum(min_dists, emd(mat, init_clusters[i:i+1])[:,0])
+
+                # Greedy kmeans++, keeping the candidate that leaves the smallest total distance to the closest centroid
+                else:
+                    candidate_dists = np.minimum(min_dists[:,None], emd(mat, mat[choice]))
+                    best = np.argmin(np.sum(candidate_dists, axis=0))
+                    init_clusters[i] = mat[choice[best]]
+                    min_dists = candidate_dists[:,best]
+
+            return init_clusters
+
+    elif init == 'k-means||':
+        with span('seed_centroids', count=n) as record:
+            if oversampling is None: oversampling = 2 * k
+            candidates = [rng.integers(0, n)]
+            min_dists = emd(mat, mat[candidates])[:,0]
+            closest = np.zeros(n, dtype=np.int64)
+
+            # Oversampling rounds, each adding every histogram as a candidate with probability proportional to its distance to the closest candidate
+            for round_number in range(n_rounds):
+                if np.sum(min_dists) == 0: break
+                new = np.flatnonzero(rng.random(n) < oversampling * min_dists / np.sum(min_dists))
+                if len(new) == 0: continue
+                new_dists = emd(mat, mat[new])
+                nearest = np.argmin(new_dists, axis=1)
+                nearest_dists = new_dists[np.arange(n), nearest]
+                closer = nearest_dists < min_dists
+                closest[closer] = len(candidates) + nearest[closer]
+                min_dists[closer] = nearest_dists[closer]
+                candidates.extend(new)
+
+            # Topping the candidates up at random if too few were drawn
+            if len(candidates) < k:
+                remaining = np.setdiff1d(np.arange(n), candidates)
+                candidates.extend(rng.choice(remaining, k - len(candidates), replace=False))
+            candidates = mat[np.array(candidates)]
+            counts = np.bincount(closest, minlength=len(candidates)).astype(np.float64)
+
+            # Weighted kmeans++ on the candidates
+            candidate_dists = emd(candidates, candidates)
+            chosen = [rng.choice(len(candidates), p=probabilities(counts))]
+            candidate_min = candidate_dists[:, chosen[0]]
+            for i in range(1, k):
+                p = counts * candidate_min
+                if np.sum(p) == 0: p = np.where(np.isin(np.arange(len(candidates)), chosen), 0, 1)
+                chosen.append(rng.choice(len(candidates), p=probabilities(p)))
+                candidate_min = np.minimum(candidate_min, candidate_dists[:, chosen[-1]])
+
+            record['message'] = f'k-means|| initialization from {len(candidates)} candidates'
+
+            return candidates[chosen]
+
+    # Otherwise using random initiation
+    elif init == 'random':
+        # Randomly picking k observations to use as initial clusters
+        return mat[rng.choice(len(mat), k, replace=False)]  # (k, d)
+
+    else:
+        raise Exception (f'Enter valid option for init. Enter "k-means++" to use kmeans++, "k-means||" to use kmeans||, "random" for random initiation, or set equal to a (k, n_tau_bins * n_pressure_bins) shaped ndarray to use as initial clusters. You entered {init}')
+
+# Assignment step of emd_means that uses the triangle inequality (Elkan's bounds) to skip EMDs that cannot change a histograms label
+# lower is the (n, k) array of lower bounds on the EMD between each histogram and each of old_centroids, which is updated in place for centroids
+# Returns the new labels, the EMD between each histogram and its assigned centroid, and the number of EMDs that were computed
+# The bounds are only guaranteed for a true metric, so with emd_backend = "sinkhorn" the labels can differ very slightly from an unpruned assignment
+def emd_pruned_assignment(mat, centroids, old_centroids, labels, lower, emd):
+    n, k = lower.shape
+
+    # EMD moved by each centroid since the last iteration, and the EMDs between the new centroids
+    centroid_dists = emd(np.concatenate([old_centroids, centroids]), centroids)
+    drift = np.diag(centroid_dists[:k])
+    centroid_dists = centroid_dists[k:]
+    n_computed = 2 * k * k
+
+    # A centroid can only have moved drift[j] closer to each histogram
+    lower -= drift[None,:]
+    np.maximum(lower, 0, out=lower)
+
+    # Exact distance of each histogram to its current centroid, needed for the inertia anyway
+    assigned = np.zeros(n)
+    for i in range(k):
+        members = np.flatnonzero(labels == i)
+        if len(members): assigned[members] = emd(mat[members], centroids[i:i+1])[:,0]
+    lower[np.arange(n), labels] = assigned
+    n_computed += n
+
+    # Centroid j can only be closer than a histograms current centroid if the lower bound on its distance, and half the distance between the two centroids, are smaller than the current distance
+    candidates = (assigned[:,None] > lower) & (assigned[:,None] > 0.5 * centroid_dists[labels])
+    candidates[np.arange(n), labels] = False
+    for i in range(k):
+        rows = np.flatnonzero(candidates[:,i])
+        if len(rows): lower[rows, i] = emd(mat[rows], centroids[i:i+1])[:,0]
+        n_computed += len(rows)
+
+    # Choosing the closest centroid out of the current centroid and the candidates, all of which now have exact distances in lower
+    candidates[np.arange(n), labels] = True
+    exact = np.where(candidates, lower, np.inf)
+    labels = np.argmin(exact, axis=1)
+    assigned = exact[np.arange(n), labels]
+
+    return labels, assigned, n_computed
+
+# Mean of the histograms in mat assigned to each of k clusters by labels, weighted by weights if they are given. Sums are accumulated in float64 a block of
+# histograms at a time, so mat can be float32 or quantized without being copied whole. Clusters with no histograms get a mean of nan
+def cluster_means(mat, labels, k, weights=None, block_size=2**16):
+    n, d = mat.shape
+    if type(weights) != np.ndarray: weights = np.ones(n)
+    sums = np.zeros((k, d))
+    for start in range(0, n, block_size):
+        stop = min(n, start + block_size)
+        onehot = sparse.csr_matrix((weights[start:stop], (labels[start:stop], np.arange(stop - start))), shape=(k, stop - start))
+        sums += onehot @ mat[start:stop]
+    with np.errstate(invalid='ignore'):
+        return sums / np.bincount(labels, weights, minlength=k)[:,None]
+
+# Fingerprint of an emd_means run: a hash of every histogram in mat, hashed a block at a time so a memmap is never read whole, and of every argument that changes
+# the result. A checkpoint is only resumed by a run with the same fingerprint
+def emd_means_fingerprint(mat, k, tol, init, n_init, hard_stop, weights, emd_backend, prune, n_candidates, init_subsample, dtype, block_size=2**16):
+    hash = hashlib.sha256()
+    hash.update(f'{mat.shape}:{mat.dtype};'.encode())
+    for start in range(0, len(mat), block_size): hash.update(np.ascontiguousarray(mat[start:start + block_size]).tobytes())
+    for array in [init, weights]:
+        hash.update(hashlib.sha256(np.ascontiguousarray(array).tobytes()).digest() if type(array) == np.ndarray else str(array).encode())
+    if callable(emd_backend): emd_backend = getattr(emd_backend, '__qualname__', repr(emd_backend))
+    hash.update(json.dumps([k, tol, n_init, hard_stop, emd_backend, prune, n_candidates, init_subsample, np.dtype(dtype).name], default=str).encode())
+    return hash.hexdigest()[:32]
+
+# Save the state of an emd_means run to path, writing to a temporary file first so a job killed while writing leaves the last checkpoint intact
+# The random number generator state is stored as JSON so the run continues with the same random numbers when resumed
+def save_emd_means_checkpoint(path, n, init_number, iter, centroids, emd_inertia_list, inertia_diff, centroid_tracking, inertia_tracking, rng, n_computed, n_skipped, fingerprint):
+    with open(path + f'.tmp{os.getpid()}', 'wb') as f:
+        np.savez(f, fingerprint=fingerprint, n=n, init_number=init_number, iter=iter, centroids=centroids, emd_inertia_list=np.array(emd_inertia_list, dtype=np.float64), inertia_diff=inertia_diff,
+                 centroid_tracking=np.array(centroid_tracking, dtype=np.asarray(centroids).dtype).reshape(len(centroid_tracking), *np.shape(centroids)), inertia_tracking=inertia_tracking,
+                 rng_state=json.dumps(rng.bit_generator.state), n_computed=n_computed, n_skipped=n_skipped)
+    os.replace(path + f'.tmp{os.getpid()}', path)
+
+# Load a checkpoint written by save_emd_means_checkpoint, checking it belongs to a run with the same number of histograms, clusters and initiations, and the same fingerprint
+# (see emd_means_fingerprint). Restores the state of rng in place and returns the rest of the state as a dictionary
+def load_emd_means_checkpoint(path, n, k, d, n_init, rng, fingerprint):
+    with np.load(path) as f: checkpoint = {key: f[key] for key in f.files}
+    if checkpoint['centroids'].shape != (k, d) or len(checkpoint['inertia_tracking']) != n_init:
+        raise Exception (f'Checkpoint {path} is for a run with k = {len(checkpoint["centroids"])} and n_init = {len(checkpoint["inertia_tracking"])}, not k = {k} and n_init = {n_init}')
+    if checkpoint['n'] != n: raise Exception (f'Checkpoint {path} is for {checkpoint["n"]} histograms, not {n}')
+    if str(checkpoint.get('fingerprint')) != fingerprint:
+        raise Exception (f'Checkpoint {path} was saved by a run on different data or with different arguments. Delete it or pass a different resume_from to start a new run')
+    rng.bit_generator.state = json.loads(str(checkpoint.pop('rng_state')))
+    return checkpoint
+
+# K-means algorithm that uses wasserstein distance
+# With prune = True, bounds from the triangle inequality are used to skip EMDs that cannot change the cluster labels. The number of computed and skipped EMDs is logged
+# and added to distance_counts if a dictionary is passed
+# With n_jobs > 1 the n_init initiations are run in parallel across n_jobs worker processes (n_jobs = None uses one process per available CPU)
+# config is a RuntimeConfig setting the number of threads, random number generator and floating point type to use
+# init can be "k-means++", "k-means||", "random" or a (k, n_tau_bins * n_pressure_bins) ndarray. n_candidates and init_subsample are passed to emd_init_centroids
+# If checkpoint_path is set the centroids, inertia history, initiation number and random number generator state are saved there every checkpoint_every iterations.
+# A run started with resume_from set to a checkpoint continues from where that checkpoint was saved, or starts from the beginning if the file does not exist yet.
+# Resuming a checkpoint saved on different data or with different arguments raises an exception. The checkpoint is deleted once the run finishes
+@span('emd_means')
+def emd_means(mat, k, tol, init, n_init, ds, tau_var_name, ht_var_name, hard_stop = 45, weights = None, emd_backend = "wasserstein", prune = False, distance_counts = None, n_jobs = 1, config = None, n_candidates = 1, init_subsample = None,
+              checkpoint_path = None, checkpoint_every = 1, resume_from = None):
+    if config is None: config = RuntimeConfig()
+
+    # Running the n_init initiations in parallel across n_jobs processes if asked to
+    if n_jobs != 1 and n_init > 1 and type(init) != np.ndarray:
+        if checkpoint_path is not None or resume_from is not None: raise Exception ('Checkpointing is only supported with n_jobs = 1')
+        kwargs = dict(k=k, tol=tol, init=init, n_init=1, ds=coordinates_only(ds, tau_var_name, ht_var_name), tau_var_name=tau_var_name, ht_var_name=ht_var_name,
+                      hard_stop=hard_stop, weights=weights, emd_backend=emd_backend, prune=prune, n_candidates=n_candidates, init_subsample=init_subsample)
+        return combine_emd_means_results(run_in_process_pool(mat, [("wasserstein", kwargs)] * n_init, n_jobs, config))
 
     n, d = mat.shape
 
     # checking for a weights array to prefrom a weighted kmeans with
-    if type(weights) == np.ndarray: 
-        weighted = True
-        mat_w = mat * weights[:,None]
+    if type(weights) == np.ndarray: weighted = True
     else: weighted = False
 
-    centroid_labels = np.arange(k, dtype=np.int32)  # (k, )
-  
+    # Doing more than one init with an init array is useless, as they will all have the same result
+    if type(init) == np.ndarray:
+        if init.shape != (k,d): raise Exception ('init array must be shape (k, n_tau_bins * n_pressure_bins)')
+        n_init = 1
+
     centroid_tracking = []
     inertia_tracking = np.zeros(n_init)
 
@@ -394,131 +1316,275 @@ def emd_means(mat, k, tol, init, n_init, ds, tau_var_name, ht_var_name, hard_sto
     n1 = len(ds[tau_var_name])
     n2 = len(ds[ht_var_name])
 
-    # Calculating the max distance between two points to be used as hyperparameter in EMD
-    # This is not necesarily the only value for this variable that can be used, see Wasserstein documentation
-    # on R hyper-parameter for more information
-    R = (n1**2+n2**2)**0.5
+    # Function to calculate EMDs with the chosen backend
+    emd = emd_distance_function(n1, n2, emd_backend, config=config)
+
+    # Counting the EMDs calculated and skipped during the assignment steps
+    n_computed, n_skipped = 0, 0
+
+    # Picking up the state of a previous run from its checkpoint
+    first_init, checkpoint, fingerprint = 0, None, None
+    if checkpoint_path is not None or resume_from is not None:
+        fingerprint = emd_means_fingerprint(mat, k, tol, init, n_init, hard_stop, weights, emd_backend, prune, n_candidates, init_subsample, config.dtype)
+    if resume_from is not None and os.path.isfile(resume_from):
+        checkpoint = load_emd_means_checkpoint(resume_from, n, k, d, n_init, config.rng, fingerprint)
+        first_init = int(checkpoint['init_number'])
+        centroid_tracking = list(checkpoint['centroid_tracking'])
+        inertia_tracking = checkpoint['inertia_tracking']
+        n_computed, n_skipped = int(checkpoint['n_computed']), int(checkpoint['n_skipped'])
+        if centroid_tracking: centroids = centroid_tracking[-1]
+        lgr.info(f" Resuming from {resume_from} at iteration {int(checkpoint['iter'])} of initiation {first_init+1} out of {n_init}")
+    elif resume_from is not None: lgr.info(f" No checkpoint found at {resume_from}, starting from the beginning")
 
-    # Creating a flattened position matrix to pass wasersstein.PairwiseEMD
-    position_matrix = np.zeros((2,n1,n2))
-    position_matrix[0] = np.tile(np.arange(n2),(n1,1))
-    position_matrix[1] = np.tile(np.arange(n1),(n2,1)).T
-    position_matrix = position_matrix.reshape(2,-1)
+    # Preforming n_init initiations of the kmeans algorithm, and then keeping the best initiation as a result
+    for init_number in range(first_init, n_init):
+
+        # Continuing the initiation that was running when the checkpoint was saved
+        if checkpoint is not None and checkpoint['iter'] > 0:
+            centroids = checkpoint['centroids']
+            iter = int(checkpoint['iter'])
+            emd_inertia_list = list(checkpoint['emd_inertia_list'])
+            inertia_diff = float(checkpoint['inertia_diff'])
+            emd_inertia = emd_inertia_list[-1]
+        else:
+            # Using array entered as init as initial centroids if init is an ndarray
+            if type(init) == np.ndarray: centroids = init
 
-    # Initialising wasserstein.PairwiseEMD
-    emds = wasserstein.PairwiseEMD(R = R, norm=True, dtype=np.float32, verbose=0, num_threads=162)
+            # Otherwise using kmeans++ or random initiation
+            else:
+                centroids = emd_init_centroids(mat, k, init, emd, config.rng, n_candidates, init_subsample)
 
-    # Rearranging mat to be in the format necesary for wasserstein.PairwiseEMD
-    events = stacking(position_matrix, mat)
+            iter = 0
+            emd_inertia_list = []
 
-    # Preforming n_init initiations of the kmeans algorithm, and then keeping the best initiation as a result
-    for init_number in range(n_init):
-        emd_inertia_list = []
+            # initializing inertia_diff so loop will run, true values is calculated after the second iteration
+            inertia_diff = tol+1
+        checkpoint = None
 
-        # Using Kmeans++ if init  == True
-        if init == 'k-means++':
-            init_clusters = np.zeros((k, len(mat[0])))
-            init_clusters[0] = mat[np.random.randint(0,len(mat))]
-            centroid_list = stacking(position_matrix, init_clusters)
+        # The pruning bounds are not checkpointed, so the first assignment after starting or resuming computes every EMD
+        first_iter = iter
+        while inertia_diff >= tol and iter < hard_stop:
+
+            # ASSIGNMENT STEP
+            with span('emd_assignment') as record:
+                if prune and iter > first_iter:
+                    labels, assigned, computed = emd_pruned_assignment(mat, centroids, old_centroids, labels, distances, emd)
+                    lgr.info(f" {computed} EMDs computed, {n * k - computed} skipped")
+                    n_computed += computed
+                    n_skipped += n * k - computed
+                    record['count'] = computed
+                else:
+                    distances = emd(mat, centroids)
+                    labels = np.argmin(distances, axis=1)
+                    assigned = distances[np.arange(n), labels]
+                    n_computed += n * k
+                    record['count'] = n * k
+            old_centroids = centroids
+
+            #calculating emd_inertia
+            if weighted: emd_inertia = np.sum((assigned*weights/np.sum(weights))**2)
+            else: emd_inertia = np.sum(assigned**2)
+            emd_inertia_list.append(emd_inertia)
+            
+            # Updating cluster centroids, as area weighted averages if weights were given
+            with span('centroid_update', count=n):
+                centroids = cluster_means(mat, labels, k, weights)
 
-            dists_ar = np.full((len(mat),k-1), np.inf)
-            x = perf_counter()
-            for i in range(k-1):
-                emds(events,centroid_list[i:i+1])
-                dists_ar[:,i] = emds.emds().squeeze()
-                weights_kpp = np.min(dists_ar, axis=1)
-                weights_kpp = weights_kpp / np.sum(weights_kpp)
+            # Calculate change in inertia from last step
+            if iter > 0:
+                inertia_diff = emd_inertia_list[-2] - emd_inertia_list[-1]
+                lgr.info(f" Change in inertia from last iteration = {round(inertia_diff,1)}")
 
-                choice = np.random.choice(np.arange(len(mat)), 1, p=weights_kpp)
-                init_clusters[i+1] = mat[choice]
-                centroid_list = stacking(position_matrix, init_clusters)
+            iter += 1
+
+            if checkpoint_path is not None and iter % checkpoint_every == 0:
+                save_emd_means_checkpoint(checkpoint_path, n, init_number, iter, centroids, emd_inertia_list, inertia_diff, centroid_tracking, inertia_tracking, config.rng, n_computed, n_skipped, fingerprint)
+
+        # Check if we've reached the hard stop on number of iterations
+        if iter == hard_stop:
+            lgr.warning(f" max_iter = {hard_stop} reached, this run may not have converged")
+            lgr.info(f" tol = {tol}, final change in inertia = {round(inertia_diff,1)}, final inertia = {round(emd_inertia,1)}")
+
+        lgr.info(f" {iter} iterations until convergence with tol = {tol} ")
+
+        centroid_tracking.append(centroids)
+        inertia_tracking[init_number] = emd_inertia
 
-            lgr.info(f" {round(perf_counter()-x,1)} Seconds for k-means++ initialization:")
+        if checkpoint_path is not None:
+            save_emd_means_checkpoint(checkpoint_path, n, init_number+1, 0, centroids, [], tol+1, centroid_tracking, inertia_tracking, config.rng, n_computed, n_skipped, fingerprint)
 
-            centroids = init_clusters
+        lgr.info(f" Finished initiation {init_number+1} out of {n_init} ")
         
+
+    # retreiving the cluster centers that had the lowest inertia
+    best_result = np.argmin(inertia_tracking)
+
+    # recaluclating cluster labels to the final updated cluster centers of the best initiation
+    with span('final_assignment', count=n * k):
+        distances = emd(mat, centroid_tracking[best_result])
+        labels = np.argmin(distances, axis=1)
+        n_computed += n * k
+
+    if prune: lgr.info(f" {n_computed} EMDs computed and {n_skipped} skipped ({round(100 * n_skipped / (n_computed + n_skipped), 1)}%)")
+    if distance_counts is not None:
+        distance_counts['computed'] = distance_counts.get('computed', 0) + n_computed
+        distance_counts['skipped'] = distance_counts.get('skipped', 0) + n_skipped
+
+    # A finished run's checkpoint would only hand its result to the next run resuming from it
+    if checkpoint_path is not None and os.path.isfile(checkpoint_path): os.remove(checkpoint_path)
+
+    return centroid_tracking[best_result], labels, inertia_tracking, centroid_tracking
+
+# Mini-batch version of emd_means: centroids are updated incrementally from random batches of histograms instead of from every histogram each iteration
+# Convergence is checked on the inertia of each batch to the centroids it was assigned to, which costs no extra EMDs, smoothed with an exponentially weighted average
+# over batches as it jumps from batch to batch. A run stops once the smoothed inertia has not improved on its lowest value by at least a fraction tol for max_no_improvement batches
+# in a row, once the centroids stop moving: when the sum of their squared (euclidean) moves in a batch is under center_tol times the mean variance of a held out sample
+# of holdout_size histograms, like sklearn's MiniBatchKMeans, or after hard_stop batches. hard_stop defaults to max_epochs passes over mat
+# The best initiation is picked by its inertia on the held out sample, which is computed once at the end of each initiation. Returns the same outputs as emd_means
+@span('mini_batch_emd_means')
+def mini_batch_emd_means(mat, k, tol, init, n_init, ds, tau_var_name, ht_var_name, hard_stop = None, weights = None, batch_size = 1024, emd_backend = "wasserstein", config = None, n_candidates = 1,
+                         max_no_improvement = 10, center_tol = 1e-4, max_epochs = 10, holdout_size = None):
+    if config is None: config = RuntimeConfig()
+    rng = config.rng
+
+    n, d = mat.shape
+    batch_size = min(batch_size, n)
+    if hard_stop is None: hard_stop = ceil(max_epochs * n / batch_size)
+    if holdout_size is None: holdout_size = 10 * batch_size
+
+    # checking for a weights array to prefrom a weighted kmeans with, otherwise every histogram has a weight of 1
+    if type(weights) == np.ndarray: weighted = True
+    else:
+        weighted = False
+        weights = np.ones(n)
+
+    # Doing more than one init with an init array is useless, as they will all have the same result
+    if type(init) == np.ndarray:
+        if init.shape != (k,d): raise Exception ('init array must be shape (k, n_tau_bins * n_pressure_bins)')
+        n_init = 1
+
+    centroid_tracking = []
+    inertia_tracking = np.zeros(n_init)
+
+    # Setting the number of tau and height dimensions for each data set
+    n1 = len(ds[tau_var_name])
+    n2 = len(ds[ht_var_name])
+
+    # Function to calculate EMDs with the chosen backend
+    emd = emd_distance_function(n1, n2, emd_backend, config=config)
+
+    # Held out sample used to compare the initiations and to scale center_tol
+    holdout = rng.choice(n, min(n, holdout_size), replace=False)
+    holdout_mat = mat[holdout]
+    holdout_weights = weights[holdout] / np.sum(weights[holdout])
+    center_tol = center_tol * np.mean(np.var(holdout_mat, axis=0))
+
+    # Weight of the newest batch inertia in the smoothed inertia, averaging over about max_no_improvement batches
+    alpha = 2 / (max_no_improvement + 1)
+
+    # Preforming n_init initiations of the kmeans algorithm, and then keeping the best initiation as a result
+    for init_number in range(n_init):
+        emd_inertia_list = []
+
         # Using array entered as init as initial centroids if init is an ndarray
-        elif type(init) == np.ndarray:
-            if init.shape != (k,d): raise Exception ('init array must be shape (k, n_tau_bins * n_pressure_bins)')
-            centroids = init
-            n_init = 1 # Doing more than one init in this case is useless, as they will all have the same result
-        
-        # Otherwise using random initiation
-        elif init == 'random':
-            # Randomly picking k observations to use as initial clusters
-            centroids = mat[np.random.choice(n, k, replace=False)]  # (k, d)
+        if type(init) == np.ndarray:
+            centroids = init.astype(np.float64)
 
+        # Otherwise using kmeans++ or random initiation on a random subsample of mat, as seeding on all of mat would cost as much as a full emd_means iteration
         else:
-            raise Exception (f'Enter valid option for init. Enter "k-means++" to use kmeans++, "random" for random initiation, or set equal to a (k, n_tau_bins * n_pressure_bins) shaped ndarray to use as initial clusters. You entered {init}')
+            init_sample = mat[rng.choice(n, min(n, max(3 * batch_size, k)), replace=False)]
+            centroids = emd_init_centroids(init_sample, k, init, emd, rng, n_candidates).astype(np.float64)
 
-        iter = 0
+        # Total weight of the histograms assigned to each centroid so far, which sets the per-centroid learning rate
+        counts = np.zeros(k)
 
-        # initializing inertia_diff so loop will run, true values is calculated after the second iteration
-        inertia_diff = tol+1 
-        t = 0
-        while inertia_diff >= tol:
+        iter = 0
+        smoothed_inertia, lowest_inertia, no_improvement = None, np.inf, 0
+        while True:
+            old_centroids = centroids.copy()
 
-            # ASSIGNMENT STEP
-            centroid_list = stacking(position_matrix, centroids)
-            emds(events, centroid_list)
-            distances = emds.emds()
+            # ASSIGNMENT STEP on a random batch
+            batch = rng.choice(n, batch_size, replace=False)
+            distances = emd(mat[batch], centroids)
             labels = np.argmin(distances, axis=1)
 
-            #calculating emd_inertia
-            onehot_matrix = labels[:,None] == centroid_labels  # (n, k)
-            if weighted: emd_inertia = np.sum((distances[onehot_matrix]*weights/np.sum(weights))**2)
-            else: emd_inertia = np.sum(distances[onehot_matrix]**2)
+            # Calculating emd_inertia on the batch, before the centroids are moved
+            assigned = distances[np.arange(batch_size), labels]
+            if weighted: emd_inertia = np.sum((assigned*weights[batch]/np.sum(weights[batch]))**2)
+            else: emd_inertia = np.sum(assigned**2)
             emd_inertia_list.append(emd_inertia)
-            
-            # Updating cluster centroids
-            if weighted == False:
-                b_data, b_oh = np.broadcast_arrays(  # (n, k, d), (n, k, d)
-                    mat[:, None], onehot_matrix[:, :, None])
-                centroids =  b_data.mean(axis=0, where=b_oh)  # (k, d)
-            
-            # Updating cluster centers as area weighted average
-            if weighted == True:
-                centroids = np.zeros((k,d))
-                for i in range (k):
-                    centroids[i] = np.sum(mat_w[np.where(labels == i)], axis = 0) / np.sum(weights[np.where(labels == i)])
 
-            # Calculate change in inertia from last step
-            if iter > 0:
-                inertia_diff = emd_inertia_list[-2] - emd_inertia_list[-1]
-                lgr.info(f" Change in inertia from last iteration = {round(inertia_diff,1)}")
+            # Moving each centroid towards the weighted mean of its batch members, with a learning rate of (batch weight / total weight seen by the centroid)
+            for i in np.unique(labels):
+                members = batch[labels == i]
+                batch_weight = np.sum(weights[members])
+                counts[i] += batch_weight
+                batch_mean = np.sum(mat[members] * weights[members][:,None], axis=0) / batch_weight
+                centroids[i] += batch_weight / counts[i] * (batch_mean - centroids[i])
+
+            # Counting the batches since the smoothed inertia last improved on its lowest value by at least a fraction tol of it, as the scale of the inertia depends on the weights
+            if smoothed_inertia is None: smoothed_inertia = emd_inertia
+            else: smoothed_inertia = alpha * emd_inertia + (1 - alpha) * smoothed_inertia
+            if smoothed_inertia <= lowest_inertia * (1 - tol): no_improvement = 0
+            else: no_improvement += 1
+            lowest_inertia = min(lowest_inertia, smoothed_inertia)
+            center_shift = np.sum((centroids - old_centroids)**2)
+            lgr.info(f" Smoothed batch inertia = {round(smoothed_inertia,1)}, {no_improvement} batches without improvement")
 
             iter += 1
-        
+
+            if no_improvement >= max_no_improvement:
+                lgr.info(f" Smoothed inertia has not improved by a fraction tol = {tol} in {max_no_improvement} batches")
+                break
+            if center_shift <= center_tol:
+                lgr.info(f" Centroids moved by {center_shift}, under center_tol")
+                break
+
             # Check if we've reached the hard stop on number of iterations
             if iter == hard_stop:
-                lgr.warning(f" max_iter = {hard_stop} reached, this run may not have converged")
-                lgr.info(f" tol = {tol}, final change in inertia = {round(inertia_diff,1)}, final inertia = {round(emd_inertia,1)}")
+                lgr.warning(f" hard_stop = {hard_stop} batches reached, this run may not have converged")
+                lgr.info(f" tol = {tol}, final smoothed inertia = {round(smoothed_inertia,1)}, final inertia = {round(emd_inertia,1)}")
                 break
 
-        lgr.info(f" {iter} iterations until convergence with tol = {tol} ")
+        lgr.info(f" {iter} batches until convergence with tol = {tol} ")
+
+        # Calculating emd_inertia on the held out sample, so the initiations are compared on the same histograms
+        distances = np.min(emd(holdout_mat, centroids), axis=1)
+        if weighted: emd_inertia = np.sum((distances*holdout_weights)**2)
+        else: emd_inertia = np.sum(distances**2)
 
         centroid_tracking.append(centroids)
         inertia_tracking[init_number] = emd_inertia
 
         lgr.info(f" Finished initiation {init_number+1} out of {n_init} ")
-        
 
     # retreiving the cluster centers that had the lowest inertia
     best_result = np.argmin(inertia_tracking)
+    centroids = centroid_tracking[best_result]
 
-    # recaluclating cluster labels to the final updated cluster centers
-    centroid_list = stacking(position_matrix, centroids)
-    emds(events, centroid_list)
-    distances = emds.emds()
-    labels = np.argmin(distances, axis=1)
+    # Calculating cluster labels for all of mat in blocks of histograms, so the full set of events never has to be held in memory at once
+    labels = np.zeros(n, dtype=np.int64)
+    block_size = 100 * batch_size
+    for start in range(0, n, block_size):
+        labels[start:start + block_size] = np.argmin(emd(mat[start:start + block_size], centroids), axis=1)
 
-    return centroid_tracking[best_result], labels, inertia_tracking, centroid_tracking
+    return centroids, labels, inertia_tracking, centroid_tracking
 
 # Conventional kmeans using sklearn
-def euclidean_kmeans(k, init, n_init, mat, max_iter, tol, gpu = False):
+# config is a RuntimeConfig setting the number of threads and random number generator sklearn uses
+# weights are passed to KMeans as sample_weight, for example the weights of a coreset made by build_coreset
+@span('euclidean_kmeans')
+def euclidean_kmeans(k, init, n_init, mat, max_iter, tol, gpu = False, config = None, weights = None):
+    if config is None: config = RuntimeConfig()
+
+    # sklearn would copy quantized histograms to float64, float32 is enough
+    if not np.issubdtype(mat.dtype, np.floating): mat = mat.astype(np.float32)
+
     if gpu == False:
         # Seting up kmeans nd fitting the data
-        kmeans = KMeans(n_clusters=k, init = init, n_init = n_init, max_iter=max_iter+1, tol=tol).fit(mat)
+        kmeans = KMeans(n_clusters=k, init = init, n_init = n_init, max_iter=max_iter+1, tol=tol, random_state=int(config.rng.integers(2**31)))
+        with threadpool_limits(limits=config.num_threads):
+            kmeans.fit(mat, sample_weight=weights)
         # Retreiving cluster labels
         cluster_labels_temp = kmeans.labels_
         # Retreiving cluster centers
@@ -541,7 +1607,7 @@ def euclidean_kmeans(k, init, n_init, mat, max_iter, tol, gpu = False):
         # Initializing kmeans
         kmeans=cuml.cluster.KMeans(n_clusters=k, max_iter=max_iter+1, init=init, tol= tol, n_init=n_init, output_type = "numpy")
         # Fitting data
-        kmeans.fit(gpu_mat)
+        kmeans.fit(gpu_mat, sample_weight=weights)
         # Retreiving cluster_centers and labels
         cl = kmeans.cluster_centers_
         cluster_labels_temp = kmeans.labels_
@@ -552,247 +1618,477 @@ def euclidean_kmeans(k, init, n_init, mat, max_iter, tol, gpu = False):
    
     return cl, cluster_labels_temp
 
+# Copy mat into shared memory, so worker processes can all read the same copy of it instead of each being sent a pickled copy. Memory mapped matrices are shared by file name instead
+def share_array(mat):
+    # A memory mapped matrix (not a slice of one) is already shared between processes through its file
+    if isinstance(mat, np.memmap) and isinstance(mat.base, mmap.mmap):
+        return None, (mat.filename, mat.shape, mat.dtype.str, mat.offset)
+    shm = SharedMemory(create=True, size=max(mat.nbytes, 1))
+    np.ndarray(mat.shape, dtype=mat.dtype, buffer=shm.buf)[:] = mat
+    return shm, (shm.name, mat.shape, mat.dtype.str, None)
+
+# Run one emd_means or euclidean_kmeans call in a worker process, on mat read from shared memory and with its own RuntimeConfig
+def _clustering_task(shared, wasserstein_or_euclidean, config, kwargs):
+    name, shape, dtype, offset = shared
+    if offset != None:
+        return _run_clustering(np.memmap(name, dtype=dtype, mode='r', shape=shape, offset=offset), wasserstein_or_euclidean, config, kwargs)
+    shm = SharedMemory(name=name)
+    try:
+        mat = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        result = _run_clustering(mat, wasserstein_or_euclidean, config, kwargs)
+        del mat
+    finally:
+        shm.close()
+    return result
+
+# Run emd_means or euclidean_kmeans on mat
+def _run_clustering(mat, wasserstein_or_euclidean, config, kwargs):
+    if wasserstein_or_euclidean == "wasserstein": return emd_means(mat, config=config, **kwargs)
+    elif wasserstein_or_euclidean == "euclidean": return euclidean_kmeans(mat=mat, config=config, **kwargs)
+    else: raise Exception ('Invalid option for wasserstein_or_euclidean. Please enter "wasserstein", "euclidean"')
+
+# Run a list of (wasserstein_or_euclidean, kwargs) clustering tasks on mat across a pool of n_jobs processes, in the same order they were given
+# Each task gets its own random number generator spawned from config.rng, so results are reproducible no matter how the tasks are spread over the processes,
+# and the config.num_threads threads are split evenly between the processes
+def run_in_process_pool(mat, tasks, n_jobs=None, config=None):
+    if config is None: config = RuntimeConfig()
+    if n_jobs is None: n_jobs = config.num_threads
+    n_jobs = min(n_jobs, len(tasks))
+    task_configs = [RuntimeConfig(num_threads=max(1, config.num_threads // n_jobs), rng=np.random.default_rng(child), dtype=config.dtype)
+                    for child in np.random.SeedSequence(config.rng.integers(2**63)).spawn(len(tasks))]
+
+    shm, shared = share_array(mat)
+    try:
+        with ProcessPoolExecutor(n_jobs, mp_context=get_context('spawn')) as executor:
+            futures = [executor.submit(_clustering_task, shared, method, task_config, kwargs) for (method, kwargs), task_config in zip(tasks, task_configs)]
+            results = [future.result() for future in futures]
+    finally:
+        if shm != None:
+            shm.close()
+            shm.unlink()
+    return results
+
+# Keep the best of several single initiation emd_means results, returning the same outputs as an emd_means call with n_init initiations
+def combine_emd_means_results(results):
+    inertia_tracking = np.array([result[2][0] for result in results])
+    centroid_tracking = [result[0] for result in results]
+    best_result = np.argmin(inertia_tracking)
+    return centroid_tracking[best_result], results[best_result][1], inertia_tracking, centroid_tracking
+
+# A copy of the tau and height/pressure coordinates of ds, which is all emd_means needs from it, that is cheap to send to worker processes
+def coordinates_only(ds, tau_var_name, ht_var_name):
+    return xr.Dataset(coords={tau_var_name:ds[tau_var_name].values, ht_var_name:ds[ht_var_name].values})
+
+# Preform n_trials independent clusterings of mat, as done when testing the robustness of the clusters, spread across a pool of n_jobs processes
+# kwargs are the arguments for emd_means or euclidean_kmeans other than mat. Returns a list with the outputs of emd_means or euclidean_kmeans for each trial
+# With wasserstein distance, each of the n_init initiations of each trial is run as a seperate task, so all n_trials * n_init initiations can run at once
+def run_clustering_trials(mat, n_trials, wasserstein_or_euclidean, n_jobs=None, config=None, **kwargs):
+    if wasserstein_or_euclidean == "wasserstein":
+        kwargs['ds'] = coordinates_only(kwargs['ds'], kwargs['tau_var_name'], kwargs['ht_var_name'])
+        n_init = 1 if type(kwargs.get('init')) == np.ndarray else kwargs['n_init']
+        tasks = [(wasserstein_or_euclidean, {**kwargs, 'n_init':1})] * (n_trials * n_init)
+        results = run_in_process_pool(mat, tasks, n_jobs, config)
+        return [combine_emd_means_results(results[trial * n_init:(trial + 1) * n_init]) for trial in range(n_trials)]
+
+    elif wasserstein_or_euclidean == "euclidean":
+        return run_in_process_pool(mat, [(wasserstein_or_euclidean, kwargs)] * n_trials, n_jobs, config)
+
+    else: raise Exception ('Invalid option for wasserstein_or_euclidean. Please enter "wasserstein", "euclidean"')
+
+# Wrap emd, a function made by emd_distance_function, so the EMDs between mat and the centroids passed to its keep method are kept, and are not computed again
+# when those centroids are used again, e.g. as the seeds of the next k in k_sweep. The EMDs of every other call are not kept, other than those of the most recent call
+# so keep can reuse them, and at most max_bytes of kept EMDs are held. Calls with any other array than mat are passed straight to emd.
+# The number of EMDs computed and reused is kept in the counts attribute of the returned function
+def cached_emd_function(emd, mat, max_bytes=4e9):
+    cache = {}
+    last = {}
+    def cached_emd(a, b):
+        if a is not mat: return emd(a, b)
+        keys = [np.ascontiguousarray(row).tobytes() for row in b]
+        known = {key:cache[key] if key in cache else last[key] for key in keys if key in cache or key in last}
+        missing = [i for i, key in enumerate(keys) if key not in known]
+        if len(missing): computed = emd(a, np.asarray(b)[missing])
+        cached_emd.counts['computed'] += len(a) * len(missing)
+        cached_emd.counts['reused'] += len(a) * (len(b) - len(missing))
+
+        distances = np.empty((len(a), len(b)), dtype=computed.dtype if len(missing) else next(iter(known.values())).dtype)
+        for i, key in enumerate(keys):
+            if key in known: distances[:, i] = known[key]
+        if len(missing): distances[:, missing] = computed
+        last.clear()
+        last.update({key:distances[:, i] for i, key in enumerate(keys)})
+        return distances
+
+    # Compute or reuse the EMDs to centroids, and keep them in place of the previously kept EMDs, as far as they fit in max_bytes
+    def keep(centroids):
+        distances = cached_emd(mat, centroids)
+        cache.clear()
+        for i, row in enumerate(centroids):
+            if (len(cache) + 1) * distances[:, i].nbytes > max_bytes: break
+            cache[np.ascontiguousarray(row).tobytes()] = distances[:, i].copy()
+        return distances
+
+    cached_emd.keep = keep
+    cached_emd.counts = {'computed':0, 'reused':0}
+    return cached_emd
+
+# Warm start k + 1 clusters from a k cluster solution by splitting the cluster with the highest inertia: its centroid is kept, and a second centroid is picked from
+# its members with k-means++ weighting. assigned is the distance of each histogram to its centroid, and inertia_weights weights each histograms contribution to the inertia
+def split_highest_inertia_cluster(mat, cl, labels, assigned, inertia_weights, rng):
+    inertia = np.bincount(labels, weights=inertia_weights * assigned**2, minlength=len(cl))
+    members = np.flatnonzero(labels == np.argmax(inertia))
+    p = assigned[members]**2
+    if np.sum(p) > 0: new = members[rng.choice(len(members), p=p / np.sum(p))]
+    else: new = members[rng.integers(len(members))]
+    return np.concatenate([cl, mat[new][None]])
+
+# Cluster mat for every k from k_range[0] to k_range[1] in one call. The smallest k is clustered from scratch with init and n_init, and every following k is warm started
+# from the previous solution with split_highest_inertia_cluster and clustered with a single initiation. With wasserstein the EMDs between every histogram and the final
+# centroids of each k are kept, up to emd_cache_max_bytes (see cached_emd_function), so the EMDs to the centroids that seed the next k are not computed again
+# Returns lists of the centroids, labels and inertia for each k. The inertia is calculated the same way as in emd_means, or is the sum of squared distances for euclidean
+@span('k_sweep')
+def k_sweep(mat, k_range, wasserstein_or_euclidean, tol, init, n_init, max_iter, ds=None, tau_var_name=None, ht_var_name=None, weights=None, emd_backend="wasserstein", gpu=False, config=None, emd_cache_max_bytes=4e9):
+    if config is None: config = RuntimeConfig()
+    if wasserstein_or_euclidean == "wasserstein":
+        emd = cached_emd_function(emd_distance_function(len(ds[tau_var_name]), len(ds[ht_var_name]), emd_backend, config=config), mat, emd_cache_max_bytes)
+    elif wasserstein_or_euclidean != "euclidean": raise Exception ('Invalid option for wasserstein_or_euclidean. Please enter "wasserstein", "euclidean"')
+
+    # Each histograms contribution to the inertia, matching emd_means
+    if wasserstein_or_euclidean == "wasserstein" and type(weights) == np.ndarray: inertia_weights = (weights / np.sum(weights))**2
+    else: inertia_weights = np.ones(len(mat))
+
+    cl_list, labels_list, inertia_list = [], [], []
+    for k in range(k_range[0], k_range[1] + 1):
+        with span('cluster_k', count=len(mat), message=f'cluster k = {k}'):
+            if k == k_range[0]: k_init, k_n_init = init, n_init
+            else: k_init, k_n_init = split_highest_inertia_cluster(mat, cl, labels, assigned, inertia_weights, config.rng), 1
+
+            if wasserstein_or_euclidean == "wasserstein":
+                cl, _, il, _ = emd_means(mat, k, tol, k_init, k_n_init, ds, tau_var_name, ht_var_name, max_iter, weights = weights, emd_backend = emd, config = config)
+                distances = emd.keep(cl)
+                labels = np.argmin(distances, axis=1)
+                assigned = distances[np.arange(len(mat)), labels]
+            else:
+                cl, labels = euclidean_kmeans(k, k_init, k_n_init, mat, max_iter, tol, gpu, config)
+                labels, squared_distances = euclidean_assignment(mat, cl, config=config)
+                assigned = np.sqrt(squared_distances)
+
+            cl_list.append(cl)
+            labels_list.append(labels)
+            inertia_list.append(np.sum(inertia_weights * assigned**2))
+
+    if wasserstein_or_euclidean == "wasserstein":
+        lgr.info(f" {emd.counts['computed']} EMDs between histograms and centroids computed, {emd.counts['reused']} reused")
+
+    return cl_list, labels_list, inertia_list
+
+# Build a weighted coreset of about coreset_size histograms from mat, that can be clustered in place of all of mat
+# A rough clustering is made by kmeans++ seeding k centroids from a random subsample, and histograms are then drawn with probability half proportional to their weighted
+# squared distance to the closest rough centroid, and half spread evenly over the rough clusters, so outlying histograms and small clusters are both represented.
+# Each drawn histogram is weighted by weights / (coreset_size * probability), so weighted sums over the coreset estimate the same sums over mat
+# The rough clustering uses euclidean distance, as it only sets the sampling probabilities, and a pass of EMDs over all of mat would cost as much as an emd_means iteration
+# Returns the coreset, its weights, and the indicies of the coreset histograms in mat
+@span('build_coreset')
+def build_coreset(mat, k, coreset_size, weights=None, rough_subsample=10000, config=None):
+    if config is None: config = RuntimeConfig()
+    rng = config.rng
+    n = len(mat)
+    if type(weights) != np.ndarray: weights = np.ones(n)
+    sample = np.sort(rng.choice(n, min(n, rough_subsample), replace=False))
+
+    # Rough clustering, and the squared distance of every histogram to its closest rough centroid
+    with threadpool_limits(limits=config.num_threads):
+        rough, _ = kmeans_plusplus(np.asarray(mat[sample], dtype=np.float64), k, sample_weight=weights[sample], random_state=int(rng.integers(2**31)))
+    labels, squared_distances = euclidean_assignment(mat, rough, config=config)
+
+    # Mixing sampling proportional to weighted squared distance with sampling spread evenly over the rough clusters
+    cluster_weights = np.bincount(labels, weights=weights, minlength=k)
+    p = 0.5 * weights / (len(np.flatnonzero(cluster_weights)) * cluster_weights[labels])
+    if np.sum(weights * squared_distances) > 0: p += 0.5 * weights * squared_distances / np.sum(weights * squared_distances)
+    else: p += 0.5 * weights / np.sum(weights)
+    p /= np.sum(p)
+
+    # Drawing with replacement, and merging histograms drawn more than once into a single weighted histogram
+    indicies, counts = np.unique(rng.choice(n, coreset_size, p=p), return_counts=True)
+    coreset_weights = counts * weights[indicies] / (coreset_size * p[indicies])
+    lgr.info(f' Built a coreset of {len(indicies)} out of {n} histograms:')
+
+    return mat[indicies], coreset_weights, indicies
+
+# Cluster a weighted coreset of mat (see build_coreset) instead of all of mat, and then assign every histogram in mat to the resulting centroids in a single pass
+# weights are the cos(lat) area weights, and are honored both when building the coreset and when clustering it. Returns the centroids and the labels of every histogram in mat
+@span('coreset_clustering')
+def coreset_clustering(mat, k, coreset_size, wasserstein_or_euclidean, tol, init, n_init, max_iter, weights=None, ds=None, tau_var_name=None, ht_var_name=None, emd_backend="wasserstein", gpu=False, config=None):
+    if config is None: config = RuntimeConfig()
+    if wasserstein_or_euclidean not in ["wasserstein", "euclidean"]: raise Exception ('Invalid option for wasserstein_or_euclidean. Please enter "wasserstein", "euclidean"')
+    coreset, coreset_weights, indicies = build_coreset(mat, k, coreset_size, weights, config=config)
+
+    if wasserstein_or_euclidean == "wasserstein":
+        cl, _, _, _ = emd_means(coreset, k, tol, init, n_init, ds, tau_var_name, ht_var_name, max_iter, weights = coreset_weights, emd_backend = emd_backend, config = config)
+    else:
+        cl, _ = euclidean_kmeans(k, init, n_init, coreset, max_iter, tol, gpu, config, weights = coreset_weights)
+
+    cluster_labels_temp = precomputed_clusters(mat, cl, wasserstein_or_euclidean, ds, tau_var_name, ht_var_name, emd_backend, config)
+
+    return cl, cluster_labels_temp
+
+# Assign every histogram in mat to the closest cluster center in cl with euclidean distance, returning the labels and the squared distance to the assigned center
+# Distances are calculated as ||x||^2 - 2x.c + ||c||^2 so each block of rows is a single matrix multiplication. Blocks are spread over config.num_threads threads,
+# and sized so that all of the blocks being worked on at once use no more than max_memory bytes of temporary arrays
+def euclidean_assignment(mat, cl, max_memory=2**28, config=None):
+    if config is None: config = RuntimeConfig()
+    n, d = mat.shape
+    k = len(cl)
+    cl = np.asarray(cl, dtype=np.float64)
+    cl_squared = np.sum(cl**2, axis=1)
+
+    labels = np.empty(n, dtype=np.int64)
+    distances = np.empty(n)
+
+    # Each row of a block needs a float64 copy of the histogram and a row of the (rows, k) distance matrix
+    rows = max(1, max_memory // (config.num_threads * 8 * (d + k)))
+
+    def assign_block(start):
+        block = np.asarray(mat[start:start + rows], dtype=np.float64)
+        block_distances = block @ cl.T
+        block_distances *= -2
+        block_distances += cl_squared
+        block_labels = np.argmin(block_distances, axis=1)
+        labels[start:start + rows] = block_labels
+        distances[start:start + rows] = block_distances[np.arange(len(block)), block_labels] + np.einsum('ij,ij->i', block, block)
+
+    # Each thread does its own matrix multiplications, so BLAS is kept to one thread to avoid oversubscribing the CPUs
+    with threadpool_limits(limits=1, user_api='blas'), ThreadPoolExecutor(config.num_threads) as executor:
+        list(executor.map(assign_block, range(0, n, rows)))
+
+    # Rounding errors can make the distance of a histogram to an identical center slightly negative
+    np.maximum(distances, 0, out=distances)
+
+    return labels, distances
+
 # Compute cluster labels from precomputed cluster centers with appropriate distance
-def precomputed_clusters(mat, cl, wasserstein_or_euclidean, ds, tau_var_name, ht_var_name):
+# With wasserstein, prefilter = True only computes the EMDs that cheap lower bounds can not rule out (see emd_prefiltered_assignment), exact = False prunes more aggressively
+# without guaranteeing the same labels. The number of EMDs computed and avoided is logged, and added to distance_counts if a dictionary is passed
+@span('precomputed_clusters')
+def precomputed_clusters(mat, cl, wasserstein_or_euclidean, ds, tau_var_name, ht_var_name, emd_backend = "wasserstein", config = None, prefilter = False, exact = True, distance_counts = None):
 
     if wasserstein_or_euclidean == 'euclidean':
-        cluster_dists = np.sum((mat[:,:,None] - cl.T[None,:,:])**2, axis = 1)
-        cluster_labels_temp = np.argmin(cluster_dists, axis = 1)
+        cluster_labels_temp, cluster_dists = euclidean_assignment(mat, cl, config=config)
 
     if wasserstein_or_euclidean == 'wasserstein':
 
-        # A function to convert mat into the form required for the EMD calculation
-        @njit()
-        def stacking(position_matrix, centroids):
-            centroid_list = []
-
-            for i in range(len(centroids)):
-                x = np.empty((3,len(mat[0]))).T
-                x[:,0] = centroids[i]
-                x[:,1] = position_matrix[0]
-                x[:,2] = position_matrix[1]
-                centroid_list.append(x)
-
-            return centroid_list
-        
         # setting shape
         n1 = len(ds[tau_var_name])
         n2 = len(ds[ht_var_name])
 
-        # Calculating the max distance between two points to be used as hyperparameter in EMD
-        # This is not necesarily the only value for this variable that can be used, see Wasserstein documentation
-        # on R hyper-parameter for more information
-        R = (n1**2+n2**2)**0.5
-
-        # Creating a flattened position matrix to pass wasersstein.PairwiseEMD
-        position_matrix = np.zeros((2,n1,n2))
-        position_matrix[0] = np.tile(np.arange(n2),(n1,1))
-        position_matrix[1] = np.tile(np.arange(n1),(n2,1)).T
-        position_matrix = position_matrix.reshape(2,-1)
-
-        # Initialising wasserstein.PairwiseEMD
-        emds = wasserstein.PairwiseEMD(R = R, norm=True, dtype=np.float32, verbose=1, num_threads=162)
-
-        # Rearranging mat to be in the format necesary for wasserstein.PairwiseEMD
-        events = stacking(position_matrix, mat)
-        centroid_list = stacking(position_matrix, cl)
-        emds(events, centroid_list)
-        distances = emds.emds()
-        labels = np.argmin(distances, axis=1)
+        # Calculating EMDs with the chosen backend
+        emd = emd_distance_function(n1, n2, emd_backend, verbose=0 if prefilter else 1, config=config)
+        if prefilter:
+            if config is None: config = RuntimeConfig()
+            cluster_labels_temp, cluster_dists, n_computed = emd_prefiltered_assignment(mat, cl, emd, n1, n2, exact, slack=100 * np.finfo(config.dtype).eps)
+            lgr.info(f" {n_computed} EMDs computed and {len(mat) * len(cl) - n_computed} avoided ({round(100 - 100 * n_computed / max(1, len(mat) * len(cl)), 1)}%)")
+        else:
+            distances = emd(mat, cl)
+            cluster_labels_temp = np.argmin(distances, axis=1)
+            n_computed = len(mat) * len(cl)
 
-        cluster_labels_temp = np.argmin(distances, axis=1)
+        if distance_counts is not None:
+            distance_counts['computed'] = distance_counts.get('computed', 0) + n_computed
+            distance_counts['skipped'] = distance_counts.get('skipped', 0) + len(mat) * len(cl) - n_computed
         
     return cluster_labels_temp
 
-# Create a one hot matrix where lat lon coordinates are over land using cartopy
-def create_land_mask(ds):
-    
-    land_110m = cartopy.feature.NaturalEarthFeature('physical', 'land', '110m')
-    land_polygons = list(land_110m.geometries())
-    land_polygons = [prep(land_polygon) for land_polygon in land_polygons]
+# Land masks that have already been created in this session, keyed by land_mask_cache_key
+land_mask_cache = {}
 
-    lats = ds.lat.values
-    lons = ds.lon.values
-    lon_grid, lat_grid = np.meshgrid(lons, lats)
+# Key identifying a land mask: a hash of the lat and lon coordinates and the Natural Earth resolution
+def land_mask_cache_key(lats, lons, resolution):
+    hash = hashlib.sha256()
+    hash.update(np.ascontiguousarray(lats, dtype=np.float64).tobytes())
+    hash.update(np.ascontiguousarray(lons, dtype=np.float64).tobytes())
+    hash.update(f'{len(lats)}:{len(lons)}:{resolution}'.encode())
+    return hash.hexdigest()[:32]
 
-    points = [Point(point) for point in zip(lon_grid.ravel(), lat_grid.ravel())]
-
-    land = []
-    for land_polygon in land_polygons:
-        land.extend([tuple(point.coords)[0] for point in filter(land_polygon.covers, points)])
+# Create a one hot matrix where lat lon coordinates are over land using cartopy
+# All grid points are tested against the Natural Earth land polygons at once with a shapely STRtree. Masks are cached in memory and as .npy files in cache_dir,
+# keyed by the grid coordinates and resolution, so later runs on the same grid load them instantly. Set cache_dir=False to not cache masks on disk
+@span('create_land_mask')
+def create_land_mask(ds, lat_var_name='lat', lon_var_name='lon', resolution='110m', cache_dir=None):
+    lats = ds[lat_var_name].values
+    lons = ds[lon_var_name].values
+
+    key = land_mask_cache_key(lats, lons, resolution)
+    if key in land_mask_cache: return land_mask_cache[key].copy()
+
+    if cache_dir is None: cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'cloud_regimes', 'land_masks')
+    cache_path = os.path.join(cache_dir, key + '.npy') if cache_dir != False else None
+    if cache_path != None and os.path.isfile(cache_path):
+        lgr.info(f' Loading land mask from {cache_path}')
+        oh_land = np.load(cache_path)
 
-    landar = np.asarray(land)
-    lat_lon = np.empty((len(lats)*len(lons),2))
-    oh_land = np.zeros((len(lats)*len(lons)))
-    lat_lon[:,0] = lon_grid.flatten()
-    lat_lon[:,1] = lat_grid.flatten()
+    else:
+        land = cartopy.feature.NaturalEarthFeature('physical', 'land', resolution)
+        land_polygons = np.array(list(land.geometries()), dtype=object)
+        tree = shapely.STRtree(land_polygons)
 
-    @njit()
-    def test (oh_land, lat_lon, landar):
-        for i in range(len(oh_land)):
-            check = lat_lon[i] == landar
-            if np.max(np.sum(check,axis=1)) == 2:
-                oh_land[i] = 1
-        return oh_land
-    oh_land = test (oh_land, lat_lon, landar)
+        # Natural Earth longitudes go from -180 to 180, so 0 to 360 longitudes are wrapped to match them
+        lon_grid, lat_grid = np.meshgrid((lons + 180) % 360 - 180, lats)
+        points = shapely.points(lon_grid.ravel(), lat_grid.ravel())
 
+        # Pairs of (point, polygon) indicies where a polygon covers a point
+        point_indicies, polygon_indicies = tree.query(points, predicate='intersects')
+        oh_land = np.zeros(len(points))
+        oh_land[point_indicies] = 1
+        oh_land = oh_land.reshape((len(lats),len(lons)))
 
-    oh_land=oh_land.reshape((len(lats),len(lons)))
+        if cache_path != None:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.save(cache_path + f'.tmp{os.getpid()}.npy', oh_land)
+            os.replace(cache_path + f'.tmp{os.getpid()}.npy', cache_path)
 
-    return oh_land
+    land_mask_cache[key] = oh_land
+    return oh_land.copy()
 
 # Plot histograms from k_sensitivty_testing.py
-def plot_hists_k_testing(histograms, k, ds, tau_var_name, ht_var_name, height_or_pressure, save_path):
+# With show = False the figure is only saved, on an Agg canvas without changing any rcParams or pyplot state
+@span('plot_hists_k_testing')
+def plot_hists_k_testing(histograms, k, ds, tau_var_name, ht_var_name, height_or_pressure, save_path, show=True):
     # Converting fractional data to percent to plot properly
     if np.max(histograms) <= 1:
-        histograms *= 100
+        histograms = histograms * 100
 
     # setting up plots
     ylabels = ds[ht_var_name].values
     xlabels = ds[tau_var_name].values
-    X2,Y2 = np.meshgrid(np.arange(len(xlabels) + 1), np.arange(len(ylabels+1)))
-    p = [0,0.2,1,2,3,4,6,8,10,15,99]
-    cmap = mpl.colors.ListedColormap(['white', (0.19215686274509805, 0.25098039215686274, 0.5607843137254902), (0.23529411764705882, 0.3333333333333333, 0.6313725490196078), (0.32941176470588235, 0.5098039215686274, 0.6980392156862745), (0.39215686274509803, 0.6, 0.43137254901960786), (0.44313725490196076, 0.6588235294117647, 0.21568627450980393), (0.4980392156862745, 0.6784313725490196, 0.1843137254901961), (0.5725490196078431, 0.7137254901960784, 0.16862745098039217), (0.7529411764705882, 0.8117647058823529, 0.2), (0.9568627450980393, 0.8980392156862745,0.1607843137254902)])
-    norm = mpl.colors.BoundaryNorm(p,cmap.N)
-    plt.rcParams.update({'font.size': 12})
-    n_histo = len(histograms)
-    fig_height = 1 + 10/3 * ceil(n_histo/3)
-    fig, ax = plt.subplots(figsize = (17, fig_height), ncols=3, nrows=ceil(n_histo/3), sharex='all', sharey = True)
-
-    aa = ax.ravel()
-    boundaries = p
-    norm = mpl.colors.BoundaryNorm(boundaries, cmap.N, clip=True)
-    aa[1].invert_yaxis()
-
-    # Plotting each cluster center
-    for i in range (n_histo):
-
-        im = aa[i].pcolormesh(X2,Y2,histograms[i].reshape(len(xlabels),len(ylabels)).T ,norm=norm,cmap=cmap)
-        # aa[i].set_title(f"CR {i+1}, RFO = {np.round(total_rfo,1)}%")
-
-    # setting titles, labels, etc
-    if height_or_pressure == 'p': fig.supylabel(f'Cloud-top Pressure', fontsize = 12, x = 0.09 )
-    if height_or_pressure == 'h': fig.supylabel(f'Cloud-top Height', fontsize = 12, x = 0.09  )
-    # fig.supxlabel('Optical Depth', fontsize = 12, y=0.26 )
-    cbar_ax = fig.add_axes([0.95, 0.38, 0.045, 0.45])
-    cb = fig.colorbar(im, cax=cbar_ax, ticks=p)
-    cb.set_label(label='Cloud Cover (%)', size =10)
-    cb.ax.tick_params(labelsize=9)
-    #aa[6].set_position([0.399, 0.125, 0.228, 0.215])
-    #aa[6].set_position([0.33, 0.117, 0.36, 0.16])
-    #aa[-2].remove()
-
-    bbox = aa[1].get_position()
-    p1 = bbox.p1
-    p0 = bbox.p0
-    # fig.suptitle(f'{data} Cloud Regimes', x=0.5, y=p1[1]+(1/fig_height * 0.5), fontsize=15)
-
-    bbox = aa[-2].get_position()
-    p1 = bbox.p1
-    p0 = bbox.p0
-    fig.supxlabel('Optical Depth', fontsize = 12, y=p0[1]-(1/fig_height * 0.5) )
-
-
-    # Removing extra plots
-    if n_histo > 2:
-        for i in range(ceil(k/3)*3-k):
-            aa[-(i+1)].remove()
-
-    if save_path != None:
-        plt.savefig(save_path + f'{k}k_sensitivity_testing_histograms.png')
-
-    plt.show()
-    plt.close()
-
+    X2,Y2 = np.meshgrid(np.arange(len(xlabels) + 1), np.arange(len(ylabels) + 1))
+    p = histogram_cmap_bounds
+    cmap = histogram_cmap
+    with mpl.rc_context({'font.size': 12}):
+        n_histo = len(histograms)
+        fig_height = 1 + 10/3 * ceil(n_histo/3)
+        fig = new_figure(show, figsize = (17, fig_height))
+        ax = fig.subplots(ncols=3, nrows=ceil(n_histo/3), sharex='all', sharey = True)
+
+        aa = ax.ravel()
+        boundaries = p
+        norm = mpl.colors.BoundaryNorm(boundaries, cmap.N, clip=True)
+        aa[1].invert_yaxis()
+
+        # Plotting each cluster center
+        for i in range (n_histo):
+
+            im = aa[i].pcolormesh(X2,Y2,histograms[i].reshape(len(xlabels),len(ylabels)).T ,norm=norm,cmap=cmap)
+            # aa[i].set_title(f"CR {i+1}, RFO = {np.round(total_rfo,1)}%")
+
+        # setting titles, labels, etc
+        if height_or_pressure == 'p': fig.supylabel(f'Cloud-top Pressure', fontsize = 12, x = 0.09 )
+        if height_or_pressure == 'h': fig.supylabel(f'Cloud-top Height', fontsize = 12, x = 0.09  )
+        # fig.supxlabel('Optical Depth', fontsize = 12, y=0.26 )
+        cbar_ax = fig.add_axes([0.95, 0.38, 0.045, 0.45])
+        cb = fig.colorbar(im, cax=cbar_ax, ticks=p)
+        cb.set_label(label='Cloud Cover (%)', size =10)
+        cb.ax.tick_params(labelsize=9)
+
+        bbox = aa[1].get_position()
+        p1 = bbox.p1
+        # fig.suptitle(f'{data} Cloud Regimes', x=0.5, y=p1[1]+(1/fig_height * 0.5), fontsize=15)
+
+        bbox = aa[-2].get_position()
+        p0 = bbox.p0
+        fig.supxlabel('Optical Depth', fontsize = 12, y=p0[1]-(1/fig_height * 0.5) )
+
+        # Removing extra plots
+        if n_histo > 2:
+            for i in range(ceil(k/3)*3-k):
+                aa[-(i+1)].remove()
+
+        finish_figure(fig, save_path + f'{k}k_sensitivity_testing_histograms.png' if save_path != None else None, show)
+
+
+# (len(cl1), len(cl2)) matrix of the pearson correlations between every cluster center in cl1 and every cluster center in cl2 (or cl1 again if cl2 is not given)
+# Each center is standardized once, so the whole matrix is a single matrix multiplication. Constant centers have a correlation of nan
+def histogram_correlations(cl1, cl2=None):
+    def standardize(cl):
+        cl = np.asarray(cl, dtype=np.float64).reshape(len(cl), -1)
+        cl = cl - cl.mean(axis=1, keepdims=True)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return cl / np.linalg.norm(cl, axis=1, keepdims=True)
+    z1 = standardize(cl1)
+    z2 = z1 if cl2 is None else standardize(cl2)
+    return np.clip(z1 @ z2.T, -1, 1)
+
+# (k, k) matrix of the correlations between the one hot (is / is not CR i) time series of every pair of CRs, over all valid observations in cluster_labels_temp
+# Every observation belongs to exactly one CR, so the correlations only depend on the number of observations n_i of each CR, and the (k, n_observations) one hot
+# array never has to be made: with p_i = n_i / N, corr(i, j) = (p_i * [i == j] - p_i * p_j) / sqrt(p_i * (1 - p_i) * p_j * (1 - p_j))
+def spatial_correlations(cluster_labels_temp, k):
+    labels = np.asarray(cluster_labels_temp).ravel()
+
+    # Leaving out invalid values, accounts for differing fill values
+    with np.errstate(invalid='ignore'): labels = labels[(labels >= 0) & (labels <= k-1)]
+    p = np.bincount(labels.astype(np.int64), minlength=k) / len(labels)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (np.diag(p) - np.outer(p, p)) / np.sqrt(np.outer(p * (1 - p), p * (1 - p)))
+
+# Empty correlation matrix figure with row_labels up the side and column_labels along the bottom, returning the figure, its axes, the mesh and the text of every entry
+def correlation_matrix_template(row_labels, column_labels, show):
+    fig = new_figure(show, figsize=(8, 6), dpi=150)
+    ax = fig.subplots()
+    cmap = mpl.colormaps['Spectral'].reversed()
+    mesh = ax.pcolormesh(np.zeros((len(row_labels), len(column_labels))), vmin = -1, vmax = 1, cmap = cmap)
+    fig.colorbar(mesh)
+
+    positions = np.arange(len(row_labels))+0.2
+    positions2 = np.arange(len(column_labels))+0.2
+    texts = [[ax.text(positions2[x], positions[i]+0.1, '', color='k') for x in range(len(column_labels))] for i in range(len(row_labels))]
+
+    ax.set_yticks(ticks = positions+0.3, labels = row_labels)
+    ax.set_xticks(ticks = positions2+0.3, labels = column_labels)
+
+    return fig, ax, mesh, texts
+
+# Draw a correlation matrix with the value of every entry written on it, with row_labels up the side and column_labels along the bottom, and save it to save_file
+# With show = False the figure is only saved, on an Agg canvas without changing any pyplot state. With reuse_figure = True as well, the figure is kept as a template
+# for the next correlation matrix with the same labels
+@span('draw_correlation_matrix')
+def draw_correlation_matrix(cor_coefs, row_labels, column_labels, title, save_file=None, show=True, reuse_figure=False):
+    reuse_figure = reuse_figure and not show
+    key = ('correlation_matrix', tuple(row_labels), tuple(column_labels))
+    if reuse_figure and key in figure_templates: fig, ax, mesh, texts = figure_templates[key]
+    else: fig, ax, mesh, texts = correlation_matrix_template(row_labels, column_labels, show)
+    if reuse_figure: figure_templates[key] = fig, ax, mesh, texts
+
+    # Filling in the correlation pcolormesh and the value of every entry
+    mesh.set_array(cor_coefs)
+    for i in range (len(row_labels)):
+        for x in range (len(column_labels)):
+            texts[i][x].set_text(round(cor_coefs[i,x],2))
+
+    ax.set_title(title)
+
+    finish_figure(fig, save_file, show)
 
 # Create correlation matricies between the cluster centers of all cloud regimes
-def histogram_cor(cl, save_path):
-
-    # Creating Correlation pcolormesh
-    plt.figure(figsize=(8, 6), dpi=150)
+def histogram_cor(cl, save_path, show=True):
     MxClusters = len(cl)
-    cor_coefs = np.zeros((MxClusters,MxClusters))
-
-    for i in range (MxClusters):
-        for x in range (MxClusters):
-            cor_coefs[i,x] = np.corrcoef(cl[i].flatten(),cl[x].flatten())[0,1]
-
-    cmap = plt.cm.get_cmap('Spectral').reversed()
-
-    im = plt.pcolormesh(cor_coefs, vmin = -1, vmax = 1, cmap = cmap)
-    plt.colorbar(im)
-
-    ticklabels = []
-    for i in range(MxClusters):
-        ticklabels.append(f'WS{i+1}')
-
-    positions = np.arange(MxClusters)+0.2
-    for i in range (MxClusters):
-        for x in range (MxClusters):
-            plt.text(positions[i],positions[x]+0.1, round(cor_coefs[i,x],2), color='k')
-
-    plt.xticks(ticks = positions+0.3, labels = ticklabels)
-    plt.yticks(ticks = positions+0.3, labels = ticklabels)
-
-    plt.title(f"CR Histogram Correlation Matrices, K = {MxClusters}")
-    #plt.savefig(f"/glade/work/idavis/isccp_clustering/monthly/k_correlation_testing/{MxClusters}C_correlation_matrix_{save_index}")
-
-    # plt.clf()
-    plt.show()
+    cor_coefs = histogram_correlations(cl)
 
     # if np.max(cor_coefs[np.triu_indices(MxClusters, k=1)]) > 0.8:
     #     print(f'k = {MxClusters} failed the histogram correlation test. The maximum alowable correlation is 0.8, but the maximum correlation is {round(np.max(cor_coefs[np.triu_indices(MxClusters, k=1)]),2)}')
-    
-    if save_path != None:
-        plt.savefig(save_path + f'{MxClusters}k_histogram_correlations.png')
 
-    plt.show()
-    plt.close()
+    ticklabels = [f'WS{i+1}' for i in range(MxClusters)]
+    draw_correlation_matrix(cor_coefs, ticklabels, ticklabels, f"CR Histogram Correlation Matrices, K = {MxClusters}",
+                            save_path + f'{MxClusters}k_histogram_correlations.png' if save_path != None else None, show)
 
 # Create correlation matricies between the spatial distribution of all cloud regimes
-def spatial_cor(cluster_labels_temp, k, save_path):
-
-    # Making one hot array shape (k,num_observations) where the observation = a cluster
-    all_rfo = np.zeros((k,len(cluster_labels_temp)))
-    for cluster in range(0,k):
-        all_rfo[cluster] = cluster_labels_temp == cluster
-
-    # Masking out invalid values, accounts for differing fill values
-    all_rfo = np.ma.masked_invalid(all_rfo)
-    all_rfo = np.ma.masked_where(all_rfo<0, all_rfo)
-    all_rfo = np.ma.masked_where(all_rfo>k-1, all_rfo)
-
-    # Creating Correlation pcolormesh
-    plt.figure(figsize=(8, 6), dpi=150)
-    cor_coefs = np.zeros((k,k))
-    for i in range (k):
-        for x in range (k):
-            cor_coefs[i,x] = np.ma.corrcoef(all_rfo[i],all_rfo[x])[0,1]
-
-    # Setting up plot
-    cmap = plt.cm.get_cmap('Spectral').reversed()
-    im = plt.pcolormesh(cor_coefs, vmin = -1, vmax =1, cmap = cmap)
-    plt.colorbar(im)
-
-    ticklabels = []
-    for i in range(k):
-        ticklabels.append(f'WS{i+1}')
+def spatial_cor(cluster_labels_temp, k, save_path, show=True):
 
-    positions = np.arange(k)+0.2
-    for i in range (k):
-        for x in range (k):
-            plt.text(positions[i],positions[x]+0.1, round(cor_coefs[i,x],2), color='k')
+    # Correlations between the one hot time series of each cluster, computed from the number of observations of each cluster
+    cor_coefs = spatial_correlations(cluster_labels_temp, k)
 
-    plt.xticks(ticks = positions+0.3, labels = ticklabels)
-    plt.yticks(ticks = positions+0.3, labels = ticklabels)
-
-    plt.title(f"Space-Time Correlation Matrices of WSs, K = {k}")
-   
-    if save_path != None:
-        plt.savefig(save_path + f'{k}k_space_time_correlation_matrix.png')
-
-    plt.show()
-    plt.close()
+    ticklabels = [f'WS{i+1}' for i in range(k)]
+    draw_correlation_matrix(cor_coefs, ticklabels, ticklabels, f"Space-Time Correlation Matrices of WSs, K = {k}",
+                            save_path + f'{k}k_space_time_correlation_matrix.png' if save_path != None else None, show)
 
 
     # old version that doesnt take into account time correlation
@@ -836,53 +2132,18 @@ def spatial_cor(cluster_labels_temp, k, save_path):
     # plt.show()
 
 # Create correlation matricies between the cluster centers of k and (k+1) CRs
-def kp1_histogram_cor(cl1, cl2, save_path):
-
-    # Creating Correlation pcolormesh
-    plt.figure(figsize=(8, 6), dpi=150)
+def kp1_histogram_cor(cl1, cl2, save_path, show=True):
     k1, k2 = len(cl1), len(cl2)
-    cor_coefs = np.zeros((k1,k2))
-
-    for i in range (k1):
-        for x in range (k2):
-            cor_coefs[i,x] = np.corrcoef(cl1[i].flatten(),cl2[x].flatten())[0,1]
-
-    cmap = plt.cm.get_cmap('Spectral').reversed()
-
-    im = plt.pcolormesh(cor_coefs, vmin = -1, vmax = 1, cmap = cmap)
-    plt.colorbar(im)
-
-    ticklabels = []
-    for i in range(k1):
-        ticklabels.append(f'CR{i+1}')
-    ticklabels2 = []
-    for i in range(k2):
-        ticklabels2.append(f'CR{i+1}')
-
-    positions = np.arange(k1)+0.2
-    positions2 = np.arange(k2)+0.2
-    for i in range (k1):
-        for x in range (k2):
-            plt.text(positions2[x], positions[i]+0.1, round(cor_coefs[i,x],2), color='k')
-
-    plt.yticks(ticks = positions+0.3, labels = ticklabels)
-    plt.xticks(ticks = positions2+0.3, labels = ticklabels2)
-
-    plt.title(f"K+1 Histogram Correlation Matrices")
+    cor_coefs = histogram_correlations(cl1, cl2)
 
     # mins = np.min(cor_coefs, axis=0)
     # if mins.max() < 0.5:
     #     print(f'k = {k2} is too small. A new pattern has appeared using k = {k1} ')
     # else:
     #     print(f'k = {k2} is too large. A new pattern did not appear going from k = {k1} to k = {k2}')
-    
-    if save_path != None:
-        plt.savefig(save_path + f'{k1}-{k2}_space_time_correlation_matrix.png')
-
-    plt.show()
-    plt.close()
 
-    # plt.clf()
+    draw_correlation_matrix(cor_coefs, [f'CR{i+1}' for i in range(k1)], [f'CR{i+1}' for i in range(k2)], f"K+1 Histogram Correlation Matrices",
+                            save_path + f'{k1}-{k2}_space_time_correlation_matrix.png' if save_path != None else None, show)
 
     # if np.max(cor_coefs[np.triu_indices(k, k=1)]) > 0.8:
     #     print(f'k = {k} failed the histogram correlation test. The maximum alowable correlation is 0.8, but the maximum correlation is {round(np.max(cor_coefs),2)}')
@@ -0,0 +1,51 @@
+# Checks of the functions in Functions.py, run with "python -m pytest" from the notebooks directory
+from functools import lru_cache
+import numpy as np
+import pytest
+import xarray as xr
+from Functions import RuntimeConfig, emd_means, euclidean_kmeans, precomputed_clusters, quantize_histograms
+from Benchmarks import synthetic_histograms, clustered_histograms, label_agreement
+
+k = 5
+ds = xr.Dataset(coords={'levtau':np.arange(6), 'levpc':np.arange(7)})
+
+# Smallest fraction of labels that must match the float64 labels, after matching up the clusters, for each dtype mat can be held as
+assignment_thresholds = {np.float32:0.999, np.uint16:0.995, np.uint8:0.95}
+clustering_thresholds = {np.float32:0.999, np.uint16:0.99, np.uint8:0.98}
+
+def cluster(mat, init_rows, wasserstein_or_euclidean, config):
+    if wasserstein_or_euclidean == "wasserstein": return emd_means(mat, k, 1e-3, mat[init_rows].astype(np.float64), 1, ds, 'levtau', 'levpc', 45, config=config)[:2]
+    return euclidean_kmeans(k, mat[init_rows].astype(np.float32), 1, mat, 300, 1e-4, config=config)
+
+# The float64 histograms and labels the other dtypes are checked against, clustered once for every test
+@lru_cache
+def reference(data, wasserstein_or_euclidean):
+    if data == "random": mat64 = synthetic_histograms(4000) * 100
+    else: mat64 = clustered_histograms(4000, k)[0] * 100
+    init_rows = np.random.default_rng(2).choice(len(mat64), k, replace=False)
+    reference_cl, reference_labels = cluster(mat64, init_rows, wasserstein_or_euclidean, config_for(np.float64))
+    return mat64, init_rows, reference_cl, reference_labels
+
+def config_for(dtype):
+    return RuntimeConfig(rng=np.random.default_rng(0), dtype=np.float64 if dtype == np.float64 else np.float32)
+
+# Assigning histograms held as float32 or quantized to the centroids of a float64 clustering gives the float64 labels. The histograms are random with no clusters,
+# so many lie close to the boundary between two clusters, where the precision of mat matters most
+@pytest.mark.parametrize("wasserstein_or_euclidean", ["euclidean", "wasserstein"])
+@pytest.mark.parametrize("dtype", [np.float32, np.uint16, np.uint8])
+def test_assignment_matches_float64(dtype, wasserstein_or_euclidean):
+    mat64, _, reference_cl, reference_labels = reference("random", wasserstein_or_euclidean)
+
+    mat, scale_factor = quantize_histograms(mat64, dtype)
+    labels = precomputed_clusters(mat, reference_cl / scale_factor, wasserstein_or_euclidean, ds, 'levtau', 'levpc', config=config_for(dtype))
+    assert label_agreement(np.asarray(labels).astype(int), reference_labels, k) >= assignment_thresholds[dtype]
+
+# Clustering histograms held as float32 or quantized from the same starting centroids finds the same clusters as clustering them as float64
+@pytest.mark.parametrize("wasserstein_or_euclidean", ["euclidean", "wasserstein"])
+@pytest.mark.parametrize("dtype", [np.float32, np.uint16, np.uint8])
+def test_clustering_matches_float64(dtype, wasserstein_or_euclidean):
+    mat64, init_rows, _, reference_labels = reference("clustered", wasserstein_or_euclidean)
+
+    mat, _ = quantize_histograms(mat64, dtype)
+    _, labels = cluster(mat, init_rows, wasserstein_or_euclidean, config_for(dtype))
+    assert label_agreement(labels, reference_labels, k) >= clustering_thresholds[dtype]